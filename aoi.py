@@ -0,0 +1,121 @@
+import unicodedata
+
+import numpy as np
+
+# Areas of interest on text screens (e.g. the question and the true/false
+# labels) and dwell time per area. Boxes are derived from the rendered size of
+# PsychoPy TextStims and rasterised onto a grid of `cell` pixel cells, so
+# classifying a batch of gaze samples is one array lookup, however many boxes.
+#
+# Positions are window pixels from the centre with y up, as iohub reports gaze
+# for a 'pix' window. Character boxes assume the text is laid out on its
+# explicit lines only (no wrapping) with full width CJK characters one em wide
+# and other characters half an em. Give the text stims a wrapWidth wide enough
+# for their longest line; wrapped text is detected from its height (see
+# add_text).
+
+OUTSIDE = -1
+
+# A rendered line is at most about 1.3 letter heights tall, so a text taller
+# than this many letter heights per explicit line has been wrapped
+WRAPPED_LINE_HEIGHT = 1.5
+
+
+# Width of each character in ems
+def char_widths(text):
+    return np.array([1.0 if unicodedata.east_asian_width(c) in 'WF' else 0.5 for c in text])
+
+
+# Centre, size and letter height (pixels) of the text of a TextStim, or of a
+# cached text ImageStim (see text_cache.py)
+def text_box(stim):
+    bounds = getattr(stim, 'text_bounds', None)
+    if bounds is not None:
+        return bounds
+    return stim.posPix, stim.boundingBox, stim._heightPix
+
+
+class AOIIndex:
+    def __init__(self, screen_size=(1280, 1024), cell=4):
+        self.screen_size = screen_size
+        self.cell = cell
+        shape = (-(-screen_size[1] // cell), -(-screen_size[0] // cell))
+        self.grid = np.full(shape, OUTSIDE, dtype='i4')
+        # One entry per box
+        self.labels = []
+        self.chars = []
+        self.boxes = []
+
+    # Box (x0, x1, y0, y1) in pixels -> grid cell slices
+    def _cells(self, x0, x1, y0, y1):
+        half_w, half_h = self.screen_size[0] / 2, self.screen_size[1] / 2
+        col0 = int(max(0, np.floor((x0 + half_w) / self.cell)))
+        col1 = int(max(0, np.ceil((x1 + half_w) / self.cell)))
+        # Row 0 is the top of the screen
+        row0 = int(max(0, np.floor((half_h - y1) / self.cell)))
+        row1 = int(max(0, np.ceil((half_h - y0) / self.cell)))
+        return slice(row0, row1), slice(col0, col1)
+
+    def add_box(self, x0, x1, y0, y1, label, char=''):
+        self.grid[self._cells(x0, x1, y0, y1)] = len(self.boxes)
+        self.boxes.append((x0, x1, y0, y1))
+        self.labels.append(label)
+        self.chars.append(char)
+
+    # One box per character of a centred text stim. `labels` maps each
+    # character position to an area label (default: `label` for all); e.g.
+    # the two options of the true/false strip. The character positions of a
+    # wrapped text are not known, so it gets one box over the whole text if
+    # it has a single label and none at all with `labels`. Returns whether
+    # the boxes were added.
+    def add_text(self, stim, label, labels=None):
+        (cx, cy), (width, height), letter = text_box(stim)
+        lines = stim.text.split('\n')
+        if height > WRAPPED_LINE_HEIGHT * letter * len(lines):
+            if labels is not None:
+                return False
+            self.add_box(cx - width / 2, cx + width / 2, cy - height / 2, cy + height / 2, label)
+            return True
+        line_height = height / len(lines)
+        em = max(char_widths(line).sum() for line in lines)
+        em = width / em if em else 0.0
+        position = 0
+        for row, line in enumerate(lines):
+            widths = char_widths(line) * em
+            edges = cx - widths.sum() / 2 + np.concatenate(([0.0], np.cumsum(widths)))
+            y1 = cy + height / 2 - row * line_height
+            for i, char in enumerate(line):
+                if not char.isspace():
+                    self.add_box(edges[i], edges[i + 1], y1 - line_height, y1,
+                                 label if labels is None else labels[position + i], char)
+            # Skip the newline
+            position += len(line) + 1
+        return True
+
+    # Box of each sample (OUTSIDE if none)
+    def classify(self, x, y):
+        half_w, half_h = self.screen_size[0] / 2, self.screen_size[1] / 2
+        with np.errstate(invalid='ignore'):
+            col = np.floor((np.asarray(x) + half_w) / self.cell)
+            row = np.floor((half_h - np.asarray(y)) / self.cell)
+        inside = ((col >= 0) & (col < self.grid.shape[1]) & (row >= 0) & (row < self.grid.shape[0]))
+        ids = np.full(col.shape, OUTSIDE, dtype='i4')
+        ids[inside] = self.grid[row[inside].astype('i8'), col[inside].astype('i8')]
+        return ids
+
+    # Dwell time (sec) on each area label over the valid samples (dict of
+    # time, gaze_x, gaze_y, status arrays, sorted by time). Each sample counts
+    # until the next one, at most `max_gap` sec.
+    def dwell(self, samples, max_gap=0.05):
+        time = samples['time']
+        result = {label: 0.0 for label in self.labels}
+        if not len(time):
+            return result
+        durations = np.minimum(np.diff(time, append=time[-1]), max_gap)
+        valid = samples['status'] == 0
+        ids = np.where(valid, self.classify(samples['gaze_x'], samples['gaze_y']), OUTSIDE)
+        hit = ids != OUTSIDE
+        names, codes = np.unique(np.array(self.labels), return_inverse=True)
+        totals = np.bincount(codes[ids[hit]], weights=durations[hit], minlength=len(names))
+        result.update(zip(names.tolist(), totals.tolist()))
+        return result
@@ -0,0 +1,160 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import gaze_data
+
+# Condition effects on binned time courses (e.g. target locked pupil) over
+# the cohort: bootstrap confidence intervals of the mean effect and a
+# cluster-based permutation test. Both work on one effect per participant and
+# time bin, e.g. the ContentCongruency x PitchTypicality interaction contrast.
+#
+# Resamples are drawn in fixed size chunks, each with its own seed spawned
+# from `seed`, and every chunk is one vectorised NumPy computation. The chunks
+# are spread over a process pool; the results do not depend on `jobs`.
+
+CHUNK = 500
+
+
+# Mean time course per participant and condition. `sessions` holds
+# (participant, hdf5 path, results csv path). Returns the participants, the
+# condition labels, the bin centres and an array (participants x conditions x bins).
+def participant_time_courses(sessions, by=('ContentCongruency', 'PitchTypicality'), **kwargs):
+    participants, per_session = [], []
+    conditions = []
+    for participant, hdf5_path, results_path in sessions:
+        samples = gaze_data.read_samples(hdf5_path)
+        index = gaze_data.trial_index(gaze_data.read_messages(hdf5_path))
+        times, courses = gaze_data.binned_time_courses(samples, index, **kwargs)
+        design = pd.read_csv(results_path, index_col=0).reindex(index['trial'])
+        labels = [tuple(str(v) for v in row) for row in design[list(by)].itertuples(index=False)]
+        participants.append(participant)
+        per_session.append((labels, courses))
+        conditions.extend(label for label in labels if label not in conditions)
+
+    means = np.full((len(participants), len(conditions), len(times)), np.nan)
+    for p, (labels, courses) in enumerate(per_session):
+        codes = np.array([conditions.index(label) for label in labels])
+        valid = ~np.isnan(courses)
+        sums = np.zeros((len(conditions), len(times)))
+        counts = np.zeros((len(conditions), len(times)))
+        np.add.at(sums, codes, np.where(valid, courses, 0.0))
+        np.add.at(counts, codes, valid)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[p] = np.where(counts > 0, sums / counts, np.nan)
+    return participants, conditions, times, means
+
+
+# Effect per participant and bin from condition means and a weight per
+# condition, e.g. {('congruent', 'typical'): 1, ('congruent', 'atypical'): -1,
+# ('incongruent', 'typical'): -1, ('incongruent', 'atypical'): 1}
+def contrast(means, conditions, weights):
+    w = np.array([weights.get(condition, 0.0) for condition in conditions])
+    used = w != 0
+    return np.einsum('c,pct->pt', w[used], means[:, used])
+
+
+# Seeds of the resample chunks
+def _chunk_seeds(n_resamples, seed):
+    n_chunks = -(-n_resamples // CHUNK)
+    sizes = [CHUNK] * (n_chunks - 1) + [n_resamples - CHUNK * (n_chunks - 1)]
+    return list(zip(sizes, np.random.SeedSequence(seed).spawn(n_chunks)))
+
+
+def _map_chunks(function, effects, chunks, jobs):
+    if jobs == 1:
+        return [function(effects, size, seed) for size, seed in chunks]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(function, [effects] * len(chunks),
+                             [size for size, _ in chunks], [seed for _, seed in chunks]))
+
+
+def _bootstrap_chunk(effects, size, seed):
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(effects), size=(size, len(effects)))
+    return np.nanmean(effects[picks], axis=1)
+
+
+# Percentile bootstrap CI of the mean effect over participants, per bin.
+# Returns the mean, lower and upper bounds.
+def bootstrap_ci(effects, n_resamples=10000, ci=0.95, seed=0, jobs=1):
+    effects = np.asarray(effects, dtype='f8')
+    means = np.concatenate(_map_chunks(_bootstrap_chunk, effects,
+                                       _chunk_seeds(n_resamples, seed), jobs))
+    alpha = (1.0 - ci) / 2.0
+    lower, upper = np.nanpercentile(means, [100 * alpha, 100 * (1 - alpha)], axis=0)
+    return np.nanmean(effects, axis=0), lower, upper
+
+
+# One sample t values of `effects` (participants x bins) after flipping the
+# sign of each participant by `signs` (resamples x participants)
+def _t_values(effects, signs):
+    n = len(effects)
+    mean = signs @ effects / n
+    # Sign flips do not change the squares
+    squares = (effects ** 2).sum(axis=0)
+    variance = (squares - n * mean ** 2) / (n - 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return mean / np.sqrt(variance / n)
+
+
+# Clusters of consecutive bins with |t| over the threshold and the same sign.
+# Returns per row the (start, stop, mass) of each cluster.
+def _cluster_runs(t, threshold):
+    t = np.atleast_2d(t)
+    sign = np.where(t > threshold, 1, np.where(t < -threshold, -1, 0))
+    # Pad each row so runs never continue into the next row
+    padded = np.zeros((t.shape[0], t.shape[1] + 1), dtype='i1')
+    padded[:, :-1] = sign
+    flat = padded.ravel()
+    starts = np.flatnonzero((flat != 0) & (np.concatenate(([0], flat[:-1])) != flat))
+    is_start = np.zeros(flat.size, dtype=bool)
+    is_start[starts] = True
+    run_id = np.cumsum(is_start) - 1
+    in_run = flat != 0
+    masses = np.bincount(run_id[in_run], weights=np.pad(t, ((0, 0), (0, 1))).ravel()[in_run],
+                         minlength=len(starts))
+    lengths = np.bincount(run_id[in_run], minlength=len(starts))
+    rows = starts // padded.shape[1]
+    return rows, starts % padded.shape[1], starts % padded.shape[1] + lengths, masses
+
+
+def _max_mass_chunk(effects, size, seed, threshold=None):
+    rng = np.random.default_rng(seed)
+    signs = rng.choice([-1.0, 1.0], size=(size, len(effects)))
+    t = np.nan_to_num(_t_values(effects, signs))
+    rows, _, _, masses = _cluster_runs(t, threshold)
+    largest = np.zeros(size)
+    np.maximum.at(largest, rows, np.abs(masses))
+    return largest
+
+
+class _MaxMass:
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def __call__(self, effects, size, seed):
+        return _max_mass_chunk(effects, size, seed, self.threshold)
+
+
+# Cluster-based permutation test (sign flipping, cluster mass of t values)
+# of the effect against 0. `threshold` is the cluster forming |t|; by default
+# the two sided p < .05 t value. Returns the observed t values and a list of
+# clusters as dicts with start and stop bin, mass and p value.
+def cluster_permutation_test(effects, n_permutations=5000, threshold=None, seed=0, jobs=1):
+    effects = np.asarray(effects, dtype='f8')
+    # Participants missing a bin are dropped from the test
+    effects = effects[~np.isnan(effects).any(axis=1)]
+    n = len(effects)
+    if threshold is None:
+        from scipy import stats
+        threshold = stats.t.ppf(0.975, n - 1)
+    observed = np.nan_to_num(_t_values(effects, np.ones((1, n))))[0]
+    rows, starts, stops, masses = _cluster_runs(observed, threshold)
+    null = np.concatenate(_map_chunks(_MaxMass(threshold), effects,
+                                      _chunk_seeds(n_permutations, seed), jobs))
+    clusters = [{'start': int(start), 'stop': int(stop), 'mass': float(mass),
+                 'p': float((np.sum(null >= abs(mass)) + 1) / (len(null) + 1))}
+                for start, stop, mass in zip(starts, stops, masses)]
+    return observed, clusters
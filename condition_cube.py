@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+
+# Per trial summaries of all sessions in one contiguous array, with the
+# factorial trial metadata stored as integer category codes. Group-by and
+# marginal means are bincount reductions over a combined code, so queries do
+# not need a pandas groupby over the whole cohort.
+
+# Trial metadata columns of the stim lists, plus the participant
+FACTORS = ('participant', 'SpeakerGender', 'SpeakerID', 'SentenceGroup',
+           'PitchLevel', 'ContentCongruency', 'PitchTypicality', 'Section', 'Code')
+
+
+class ConditionCube:
+    def __init__(self, factors=FACTORS, measures=()):
+        self.factors = tuple(factors)
+        self.measures = tuple(measures)
+        # Category labels of each factor; a trial's code is the label position
+        self.categories = {factor: [] for factor in self.factors}
+        # Trials are stored in the first `_size` columns; the arrays grow with
+        # spare capacity so appending session by session is not quadratic
+        self._codes = np.zeros((len(self.factors), 0), dtype='i4')
+        self._values = np.zeros((len(self.measures), 0), dtype='f8')
+        self._size = 0
+
+    # Factor codes (factors x trials)
+    @property
+    def codes(self):
+        return self._codes[:, :self._size]
+
+    # Measure values (measures x trials)
+    @property
+    def values(self):
+        return self._values[:, :self._size]
+
+    def __len__(self):
+        return self._size
+
+    def _encode(self, factor, labels):
+        categories = self.categories[factor]
+        lookup = {label: code for code, label in enumerate(categories)}
+        codes = np.empty(len(labels), dtype='i4')
+        for i, label in enumerate(labels):
+            code = lookup.get(label)
+            if code is None:
+                code = lookup[label] = len(categories)
+                categories.append(label)
+            codes[i] = code
+        return codes
+
+    # Add the trials of one or more sessions. `frame` needs a column for each
+    # factor and measure (missing measures are NaN).
+    def append(self, frame):
+        # Missing metadata gets the empty label
+        codes = np.vstack([self._encode(factor, [str(v) if pd.notna(v) else '' for v in frame[factor]])
+                           for factor in self.factors])
+        values = np.vstack([pd.to_numeric(frame[m], errors='coerce').to_numpy('f8')
+                            if m in frame else np.full(len(frame), np.nan)
+                            for m in self.measures]) if self.measures else np.zeros((0, len(frame)))
+        end = self._size + len(frame)
+        if end > self._codes.shape[1]:
+            capacity = max(end, 2 * self._codes.shape[1])
+            for name in ('_codes', '_values'):
+                old = getattr(self, name)
+                grown = np.zeros((old.shape[0], capacity), dtype=old.dtype)
+                grown[:, :self._size] = old[:, :self._size]
+                setattr(self, name, grown)
+        self._codes[:, self._size:end] = codes
+        self._values[:, self._size:end] = values
+        self._size = end
+
+    # Trials matching all of `where` ({factor: label or list of labels})
+    def mask(self, where=None):
+        keep = np.ones(len(self), dtype=bool)
+        for factor, labels in (where or {}).items():
+            if isinstance(labels, (str, int)):
+                labels = [labels]
+            categories = self.categories[factor]
+            wanted = [categories.index(str(label)) for label in labels if str(label) in categories]
+            keep &= np.isin(self.codes[self.factors.index(factor)], wanted)
+        return keep
+
+    # Sum, count and sum of squares of a measure for each combination of the
+    # `by` factors, as arrays shaped by the number of categories of each factor
+    def reduce(self, measure, by, where=None):
+        values = self.values[self.measures.index(measure)]
+        keep = self.mask(where) & ~np.isnan(values)
+        shape = tuple(len(self.categories[factor]) for factor in by)
+        key = np.zeros(int(keep.sum()), dtype='i8')
+        for factor, size in zip(by, shape):
+            key = key * size + self.codes[self.factors.index(factor)][keep]
+        size = int(np.prod(shape))
+        kept = values[keep]
+        count = np.bincount(key, minlength=size).reshape(shape)
+        total = np.bincount(key, weights=kept, minlength=size).reshape(shape)
+        squares = np.bincount(key, weights=kept * kept, minlength=size).reshape(shape)
+        return total, count, squares
+
+    # Mean of a measure for each combination of the `by` factors (NaN if empty)
+    def mean(self, measure, by, where=None):
+        total, count, _ = self.reduce(measure, by, where)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / count
+
+    # Sample standard deviation of a measure for each combination of `by`
+    def std(self, measure, by, where=None):
+        total, count, squares = self.reduce(measure, by, where)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = (squares - total * total / count) / (count - 1)
+        return np.sqrt(np.maximum(variance, 0.0))
+
+    # Means as a long DataFrame with one row per non-empty cell, e.g.
+    # cube.to_frame('pupil_change', ('participant', 'PitchTypicality', 'ContentCongruency'))
+    def to_frame(self, measure, by, where=None):
+        total, count, _ = self.reduce(measure, by, where)
+        cells = np.nonzero(count)
+        frame = pd.DataFrame({factor: np.array(self.categories[factor], dtype=object)[cell]
+                              for factor, cell in zip(by, cells)})
+        frame['n'] = count[cells]
+        frame[measure] = total[cells] / count[cells]
+        return frame
+
+    # Build a cube from results csvs (one per session) and the matching
+    # *_trial_summary.csv files written by session_export.py
+    @classmethod
+    def from_sessions(cls, sessions, measures=('track_loss', 'baseline_pupil', 'target_pupil', 'pupil_change', 'RT')):
+        cube = cls(measures=measures)
+        for participant, results_path, summary_path in sessions:
+            results = pd.read_csv(results_path, index_col=0)
+            if summary_path is not None:
+                summary = pd.read_csv(summary_path).set_index('trial')
+                results = results.join(summary, how='left')
+            results['participant'] = participant
+            cube.append(results)
+        return cube
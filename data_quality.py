@@ -0,0 +1,113 @@
+import math
+
+import numpy as np
+
+# Online eye data quality. The experiment script feeds every streamed sample of
+# a trial to a TrialQuality, which only keeps running sums (O(1) memory), and
+# stores the result next to the trial's Response. Samples can be added one by
+# one or as batches of columns (see tracker_samples.py).
+
+# Guide values for recalibrating at the next break (gaze is in window pixels)
+TRACK_LOSS_LIMIT = 0.2
+FIXATION_OFFSET_LIMIT = 60.0
+
+
+class TrialQuality:
+    def __init__(self, target=(0.0, 0.0)):
+        # Position of the fixation cross
+        self.target = target
+        self.fixation_start = math.inf
+        self.fixation_end = math.inf
+        self.n_samples = 0
+        self.n_lost = 0
+        # Time of the last sample added
+        self.last_time = -math.inf
+        self._last = None
+        self._s2s_n = 0
+        self._s2s_sq = 0.0
+        self._fix_n = 0
+        self._fix_offset = 0.0
+
+    # Samples between these (iohub) times are used for the fixation offset
+    def set_fixation(self, start, end):
+        self.fixation_start = start
+        self.fixation_end = end
+
+    def add(self, time, x, y, valid):
+        self.n_samples += 1
+        self.last_time = time
+        if not valid or math.isnan(x) or math.isnan(y):
+            self.n_lost += 1
+            # Do not measure precision across a gap
+            self._last = None
+            return
+        if self._last is not None:
+            self._s2s_n += 1
+            self._s2s_sq += (x - self._last[0]) ** 2 + (y - self._last[1]) ** 2
+        self._last = (x, y)
+        if self.fixation_start <= time < self.fixation_end:
+            self._fix_n += 1
+            self._fix_offset += math.hypot(x - self.target[0], y - self.target[1])
+
+    # Add a batch of samples (dict of time, gaze_x, gaze_y and status arrays),
+    # with the same result as adding them one by one
+    def add_samples(self, samples):
+        time, x, y = samples['time'], samples['gaze_x'], samples['gaze_y']
+        if not len(time):
+            return
+        valid = (samples['status'] == 0) & ~np.isnan(x) & ~np.isnan(y)
+        self.n_samples += len(time)
+        self.n_lost += int(len(time) - np.count_nonzero(valid))
+        self.last_time = float(time[-1])
+        # Consecutive valid pairs, continuing from the previous batch
+        last_valid = self._last is not None
+        x0, y0 = self._last if last_valid else (0.0, 0.0)
+        pairs = valid & np.concatenate(([last_valid], valid[:-1]))
+        dx = np.diff(x, prepend=x0)[pairs]
+        dy = np.diff(y, prepend=y0)[pairs]
+        self._s2s_n += len(dx)
+        self._s2s_sq += float(np.sum(dx ** 2 + dy ** 2))
+        self._last = (float(x[-1]), float(y[-1])) if valid[-1] else None
+        on_cross = valid & (time >= self.fixation_start) & (time < self.fixation_end)
+        self._fix_n += int(np.count_nonzero(on_cross))
+        self._fix_offset += float(np.sum(np.hypot(x[on_cross] - self.target[0],
+                                                  y[on_cross] - self.target[1])))
+
+    # Proportion of samples without a valid gaze position
+    @property
+    def track_loss(self):
+        return self.n_lost / self.n_samples if self.n_samples else math.nan
+
+    # RMS of the distances between consecutive valid samples
+    @property
+    def precision(self):
+        return math.sqrt(self._s2s_sq / self._s2s_n) if self._s2s_n else math.nan
+
+    # Mean distance of gaze from the fixation cross during the fixation phase
+    @property
+    def fixation_offset(self):
+        return self._fix_offset / self._fix_n if self._fix_n else math.nan
+
+    # Columns for the trial list
+    def as_dict(self):
+        return {'Samples': self.n_samples,
+                'TrackLoss': self.track_loss,
+                'PrecisionRMS': self.precision,
+                'FixationOffset': self.fixation_offset}
+
+
+# Mean quality over the trials since the last break and whether a
+# recalibration is advised
+def block_report(trial_qualities):
+    def mean(values):
+        values = [v for v in values if not math.isnan(v)]
+        return sum(values) / len(values) if values else math.nan
+
+    track_loss = mean([q['TrackLoss'] for q in trial_qualities])
+    precision = mean([q['PrecisionRMS'] for q in trial_qualities])
+    offset = mean([q['FixationOffset'] for q in trial_qualities])
+    recalibrate = track_loss > TRACK_LOSS_LIMIT or offset > FIXATION_OFFSET_LIMIT
+    return {'TrackLoss': track_loss,
+            'PrecisionRMS': precision,
+            'FixationOffset': offset,
+            'recalibrate': recalibrate}
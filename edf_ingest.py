@@ -0,0 +1,174 @@
+from array import array
+
+import numpy as np
+import tables
+
+import gaze_data
+
+# Reading the EyeLink side of a session: the ASC export (edf2asc) of the EDF
+# file the tracker records next to the iohub datastore. Samples and messages
+# come out as the same columns and trial index as gaze_data's HDF5 reader, so
+# the tracker's own 1000 Hz record can stand in when the .hdf5 is incomplete.
+#
+# The file is read line by line into typed arrays, so memory is the size of
+# the sample columns only. iter_sample_chunks() yields fixed size chunks for
+# consumers that do not need the whole session at once.
+
+# EDF message sent by the experiment script -> matching iohub message text
+EDF_MESSAGES = {'Trial_Start': gaze_data.TRIAL_START,
+                'Fixation_Start': gaze_data.FIXATION_START,
+                'Target_Start': gaze_data.TARGET_START,
+                'Trial_End': gaze_data.TRIAL_END,
+                'Practice_Start': gaze_data.PRACTICE_START,
+                'PracticeTarg_Start': gaze_data.PRACTICETARG_START,
+                'Practice_End': gaze_data.PRACTICE_END}
+
+# EyeLink gaze is in screen pixels from the top left corner; iohub reports it
+# from the centre of the window with y up
+SCREEN_SIZE = (1280, 1024)
+
+CHUNK_SIZE = 100000
+
+
+def _float(value):
+    return np.nan if value == '.' else float(value)
+
+
+# Yield dicts of sample arrays (time in EDF ms, gaze_x, gaze_y, pupil, status)
+# with at most `chunk_size` samples each. For binocular files the left eye is used.
+def iter_sample_chunks(asc_path, chunk_size=CHUNK_SIZE, screen_size=SCREEN_SIZE):
+    half_w, half_h = screen_size[0] / 2, screen_size[1] / 2
+
+    def new_chunk():
+        return {'time': array('d'), 'gaze_x': array('d'), 'gaze_y': array('d'),
+                'pupil': array('d'), 'status': array('B')}
+
+    def to_numpy(chunk):
+        return {name: np.frombuffer(column, dtype=column.typecode) if len(column)
+                else np.zeros(0, dtype=column.typecode) for name, column in chunk.items()}
+
+    chunk = new_chunk()
+    with open(asc_path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if not line[:1].isdigit():
+                continue
+            fields = line.split()
+            x, y, pupil = _float(fields[1]), _float(fields[2]), _float(fields[3])
+            missing = x != x or y != y
+            chunk['time'].append(float(fields[0]))
+            chunk['gaze_x'].append(x - half_w)
+            chunk['gaze_y'].append(half_h - y)
+            chunk['pupil'].append(0.0 if pupil != pupil else pupil)
+            chunk['status'].append(1 if missing else 0)
+            if len(chunk['time']) >= chunk_size:
+                yield to_numpy(chunk)
+                chunk = new_chunk()
+    if len(chunk['time']):
+        yield to_numpy(chunk)
+
+
+# Read the message lines as arrays of time (EDF ms), text and category. Texts
+# are translated to the iohub message texts and trials numbered in order, as
+# the EDF messages carry no trial number.
+def read_asc_messages(asc_path):
+    times, texts, categories = [], [], []
+    counters = {'trial': -1, 'practice': -1}
+    block = 'trial'
+    with open(asc_path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if not line.startswith('MSG'):
+                continue
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            # "MSG <time> [<offset>] <text>"
+            time = float(fields[1])
+            text = fields[2]
+            if len(fields) > 3 and fields[2].lstrip('-').isdigit():
+                time -= float(fields[2])
+                text = fields[3]
+            if text not in EDF_MESSAGES:
+                continue
+            # Messages shared by both blocks (e.g. Fixation_Start) belong to the
+            # block of the last start message
+            if text in ('Trial_Start', 'Practice_Start'):
+                block = 'practice' if text == 'Practice_Start' else 'trial'
+                counters[block] += 1
+            times.append(time)
+            texts.append(EDF_MESSAGES[text])
+            categories.append(str(counters[block]))
+    return {'time': np.array(times, dtype='f8'),
+            'text': np.array(texts, dtype=str),
+            'category': np.array(categories, dtype=str)}
+
+
+# Offset (sec) to add to EDF times to get iohub times, and the residual
+# timing differences of the matched messages (sec). Uses the trial index of
+# both sources; the median makes it robust to a few misplaced messages.
+def clock_offset(iohub_messages, edf_messages):
+    iohub_index = gaze_data.trial_index(iohub_messages)
+    edf_index = gaze_data.trial_index(edf_messages)
+    trials, iohub_rows, edf_rows = np.intersect1d(iohub_index['trial'], edf_index['trial'],
+                                                  return_indices=True)
+    diffs = np.concatenate([iohub_index[field][iohub_rows] - edf_index[field][edf_rows] / 1000.0
+                            for field in ('start', 'fixation', 'target', 'end')])
+    diffs = diffs[np.isfinite(diffs)]
+    if not len(diffs):
+        raise ValueError("No matching trial messages in the iohub and EDF records")
+    offset = float(np.median(diffs))
+    return offset, diffs - offset
+
+
+# Compare the message timing of the two sources trial by trial. Returns the
+# clock offset and, per trial and message, the EDF minus iohub time in ms
+# after aligning the clocks.
+def cross_check(iohub_messages, edf_messages):
+    offset, _ = clock_offset(iohub_messages, edf_messages)
+    iohub_index = gaze_data.trial_index(iohub_messages)
+    edf_index = gaze_data.trial_index(edf_messages)
+    trials, iohub_rows, edf_rows = np.intersect1d(iohub_index['trial'], edf_index['trial'],
+                                                  return_indices=True)
+    report = {'trial': trials}
+    for field in ('start', 'fixation', 'target', 'end'):
+        edf_time = edf_index[field][edf_rows] / 1000.0 + offset
+        report[field + '_diff_ms'] = (edf_time - iohub_index[field][iohub_rows]) * 1000.0
+    report['missing_in_edf'] = np.setdiff1d(iohub_index['trial'], edf_index['trial'])
+    report['missing_in_iohub'] = np.setdiff1d(edf_index['trial'], iohub_index['trial'])
+    return offset, report
+
+
+# Read a whole ASC file as gaze_data does for the .hdf5: samples and messages
+# with times in seconds. With `offset` (see clock_offset) times are on the
+# iohub clock, otherwise on the EDF clock.
+def read_asc(asc_path, offset=0.0, chunk_size=CHUNK_SIZE, screen_size=SCREEN_SIZE):
+    chunks = list(iter_sample_chunks(asc_path, chunk_size, screen_size))
+    samples = {name: np.concatenate([chunk[name] for chunk in chunks]) if chunks
+               else np.zeros(0) for name in gaze_data.SAMPLE_FIELDS}
+    samples['time'] = samples['time'] / 1000.0 + offset
+    messages = read_asc_messages(asc_path)
+    messages['time'] = messages['time'] / 1000.0 + offset
+    return samples, messages
+
+
+# Samples, messages and trial index of a session. The iohub .hdf5 is used
+# unless it is missing or has trials without samples, in which case the EDF
+# samples are used on the iohub clock (the iohub messages are kept if any).
+def load_session(hdf5_path, asc_path):
+    try:
+        samples = gaze_data.read_samples(hdf5_path)
+        messages = gaze_data.read_messages(hdf5_path)
+        index = gaze_data.trial_index(messages)
+        first, stop = gaze_data.epoch_bounds(samples['time'], index)
+        if len(index) and np.all(stop > first):
+            return samples, messages, index, 'iohub'
+    except (OSError, LookupError, tables.HDF5ExtError):
+        messages = None
+    edf_messages = read_asc_messages(asc_path)
+    if messages is not None and len(messages['time']):
+        offset, _ = clock_offset(messages, edf_messages)
+    else:
+        offset, messages = 0.0, None
+    samples, edf_messages = read_asc(asc_path, offset)
+    if messages is None:
+        messages = edf_messages
+    return samples, messages, gaze_data.trial_index(messages), 'edf'
@@ -0,0 +1,172 @@
+import numpy as np
+import tables
+
+# Reading the iohub .hdf5 datastore into NumPy columns and splitting it into
+# trials using the message events sent by the experiment script.
+
+# Message texts sent by sexuality_stereotypes_v2.py
+TRIAL_START = 'trial_start'
+TRIAL_END = 'trial_end'
+FIXATION_START = 'fixation_start'
+TARGET_START = 'target_start'
+PRACTICE_START = 'practice_start'
+PRACTICE_END = 'practice_end'
+PRACTICETARG_START = 'practice_targ_start'
+QUESTION_START = 'question_start'
+QUESTION_END = 'question_end'
+
+SAMPLE_TABLE = '/data_collection/events/eyetracker/MonocularEyeSampleEvent'
+MESSAGE_TABLE = '/data_collection/events/experiment/MessageEvent'
+
+# Sample columns kept for analysis, renamed from the iohub field names
+SAMPLE_FIELDS = {'time': 'time',
+                 'gaze_x': 'gaze_x',
+                 'gaze_y': 'gaze_y',
+                 'pupil': 'pupil_measure1',
+                 'status': 'status'}
+
+# One row per trial. Times are iohub times in seconds, NaN if a message is missing
+TRIAL_INDEX_DTYPE = np.dtype([('trial', 'i4'),
+                              ('start', 'f8'),
+                              ('fixation', 'f8'),
+                              ('target', 'f8'),
+                              ('end', 'f8')])
+
+
+# Read the eye samples as a dict of arrays, sorted by time
+def read_samples(hdf5_path, table=SAMPLE_TABLE):
+    with tables.open_file(hdf5_path, mode='r') as h5:
+        node = h5.get_node(table)
+        samples = {name: node.col(field) for name, field in SAMPLE_FIELDS.items()}
+    order = np.argsort(samples['time'], kind='stable')
+    return {name: column[order] for name, column in samples.items()}
+
+
+# Read the message events as arrays of time, text and category
+def read_messages(hdf5_path, table=MESSAGE_TABLE):
+    with tables.open_file(hdf5_path, mode='r') as h5:
+        node = h5.get_node(table)
+        time = node.col('time') + node.col('msg_offset')
+        text = np.char.decode(node.col('text'), 'utf-8')
+        category = np.char.decode(node.col('category'), 'utf-8')
+    order = np.argsort(time, kind='stable')
+    return {'time': time[order], 'text': text[order], 'category': category[order]}
+
+
+# Build the trial index from the messages. The trial number is the message
+# category; if a message was sent twice for a trial the first one is used.
+# Messages sent before the trial's start message are ignored, as the practice
+# trials send fixation_start with the same categories as the first trials.
+def trial_index(messages, start=TRIAL_START, fixation=FIXATION_START,
+                target=TARGET_START, end=TRIAL_END):
+    is_start = messages['text'] == start
+    trials = np.unique(messages['category'][is_start].astype(int))
+    index = np.zeros(len(trials), dtype=TRIAL_INDEX_DTYPE)
+    index['trial'] = trials
+    for field, text in (('start', start), ('fixation', fixation),
+                        ('target', target), ('end', end)):
+        index[field] = np.nan
+        hit = messages['text'] == text
+        category = messages['category'][hit].astype(int)
+        time = messages['time'][hit]
+        pos = np.searchsorted(trials, category)
+        found = (pos < len(trials)) & (trials[np.minimum(pos, len(trials) - 1)] == category)
+        if field != 'start':
+            found[found] &= time[found] >= index['start'][pos[found]]
+        # Messages are sorted by time, so the first occurrence is the earliest
+        rows, first = np.unique(pos[found], return_index=True)
+        index[field][rows] = time[found][first]
+    return index
+
+
+# Index of the practice trials, using the practice message texts
+def practice_index(messages):
+    return trial_index(messages, start=PRACTICE_START, target=PRACTICETARG_START,
+                       end=PRACTICE_END)
+
+
+# First and last (exclusive) sample of each trial between two index fields
+def epoch_bounds(sample_time, index, start='start', end='end'):
+    first = np.searchsorted(sample_time, index[start], side='left')
+    stop = np.searchsorted(sample_time, index[end], side='left')
+    # Trials with a missing message get an empty epoch
+    missing = np.isnan(index[start]) | np.isnan(index[end])
+    stop[missing] = first[missing]
+    return first, np.maximum(first, stop)
+
+
+# Samples with a valid gaze position
+def valid_samples(samples):
+    return ((samples['status'] == 0) & np.isfinite(samples['gaze_x'])
+            & np.isfinite(samples['gaze_y']))
+
+
+# Sum of `values` over each epoch, using cumulative sums so empty epochs are 0
+def _epoch_sums(values, first, stop):
+    cumulative = np.concatenate(([0.0], np.cumsum(values, dtype='f8')))
+    return cumulative[stop] - cumulative[first]
+
+
+# Mean of `values` over the valid samples of each epoch, NaN if there are none
+def _epoch_means(values, valid, first, stop):
+    counts = _epoch_sums(valid, first, stop)
+    sums = _epoch_sums(np.where(valid, values, 0.0), first, stop)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+# Per trial sample counts, track loss and pupil size in the baseline
+# (fixation cross) and target periods
+def trial_summaries(samples, index):
+    valid = valid_samples(samples)
+    pupil = samples['pupil']
+    first, stop = epoch_bounds(samples['time'], index)
+    n_samples = stop - first
+    n_valid = _epoch_sums(valid, first, stop)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        track_loss = np.where(n_samples > 0, 1.0 - n_valid / n_samples, np.nan)
+    base_first, base_stop = epoch_bounds(samples['time'], index, 'fixation', 'target')
+    targ_first, targ_stop = epoch_bounds(samples['time'], index, 'target', 'end')
+    baseline_pupil = _epoch_means(pupil, valid, base_first, base_stop)
+    target_pupil = _epoch_means(pupil, valid, targ_first, targ_stop)
+    return {'trial': index['trial'],
+            'duration': index['end'] - index['start'],
+            'n_samples': n_samples,
+            'track_loss': track_loss,
+            'baseline_pupil': baseline_pupil,
+            'target_pupil': target_pupil,
+            'pupil_change': target_pupil - baseline_pupil}
+
+
+# Per trial time course of a sample column (e.g. pupil) in `bin_width` sec
+# bins over `window` around the `align` message, using valid samples only.
+# With `baseline` (two index fields) the mean over that period is subtracted.
+# Returns the bin centres and an array (trials x bins), NaN for empty bins.
+def binned_time_courses(samples, index, field='pupil', align='target', window=(-0.5, 4.0),
+                        bin_width=0.05, baseline=('fixation', 'target')):
+    n_bins = int(round((window[1] - window[0]) / bin_width))
+    times = window[0] + (np.arange(n_bins) + 0.5) * bin_width
+    onset = index[align]
+    first = np.searchsorted(samples['time'], onset + window[0])
+    stop = np.searchsorted(samples['time'], onset + window[1])
+    missing = np.isnan(onset)
+    stop[missing] = first[missing]
+    valid = valid_samples(samples)
+    # Trial of every sample in a window; windows of consecutive trials do not overlap
+    trial_of = np.full(len(samples['time']), -1, dtype='i8')
+    for row, (f, s) in enumerate(zip(first, stop)):
+        trial_of[f:s] = row
+    keep = valid & (trial_of >= 0)
+    rows = trial_of[keep]
+    bins = np.floor((samples['time'][keep] - onset[rows] - window[0]) / bin_width).astype('i8')
+    inside = (bins >= 0) & (bins < n_bins)
+    flat = rows[inside] * n_bins + bins[inside]
+    size = len(index) * n_bins
+    counts = np.bincount(flat, minlength=size).reshape(len(index), n_bins)
+    sums = np.bincount(flat, weights=samples[field][keep][inside], minlength=size).reshape(len(index), n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        courses = np.where(counts > 0, sums / counts, np.nan)
+    if baseline is not None:
+        base_first, base_stop = epoch_bounds(samples['time'], index, *baseline)
+        courses -= _epoch_means(samples[field], valid, base_first, base_stop)[:, None]
+    return times, courses
@@ -0,0 +1,153 @@
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+import gaze_data
+
+# Gaze density maps per condition, built by binning the samples of all trials
+# and participants into one count array. Sessions can be added one at a time
+# and the counts saved and loaded again, so a cohort map only needs the new
+# sessions to be binned.
+#
+# Gaze is in window pixels with (0, 0) at the centre and y up, as iohub reports
+# it for the experiment window (visual.Window((1280, 1024), units='pix')).
+# Maps are indexed [y bin, x bin] with row 0 at the bottom of the screen.
+
+SCREEN_SIZE = (1280, 1024)
+
+# Trial metadata used to split the maps by default
+CONDITION_COLUMNS = ('PitchTypicality', 'ContentCongruency')
+
+
+class GazeHeatmap:
+    def __init__(self, screen_size=SCREEN_SIZE, bin_size=8, time_bins=None,
+                 epoch=('target', 'end'), max_bytes=512 * 2 ** 20):
+        self.screen_size = tuple(screen_size)
+        self.bin_size = bin_size
+        self.nx = math.ceil(screen_size[0] / bin_size)
+        self.ny = math.ceil(screen_size[1] / bin_size)
+        # Edges (sec from epoch start) of the time bins; None for one bin
+        self.time_bins = None if time_bins is None else np.asarray(time_bins, dtype='f8')
+        self.nt = 1 if time_bins is None else len(time_bins) - 1
+        # Trial index fields the samples are taken between
+        self.epoch = epoch
+        self.max_bytes = max_bytes
+        self.conditions = []
+        self.sessions = set()
+        self.counts = np.zeros((0, self.nt, self.ny, self.nx))
+
+    # Bytes used by the count array for `n_conditions` conditions
+    def nbytes(self, n_conditions):
+        return n_conditions * self.nt * self.ny * self.nx * 8
+
+    def _condition_rows(self, labels):
+        new = [label for label in dict.fromkeys(labels) if label not in self.conditions]
+        if new:
+            if self.nbytes(len(self.conditions) + len(new)) > self.max_bytes:
+                raise MemoryError(f"{len(self.conditions) + len(new)} conditions at "
+                                  f"{self.bin_size} pix bins exceed max_bytes; "
+                                  "use a larger bin_size or fewer time bins")
+            self.conditions.extend(new)
+            grown = np.zeros((len(self.conditions), self.nt, self.ny, self.nx))
+            grown[:len(self.counts)] = self.counts
+            self.counts = grown
+        return np.array([self.conditions.index(label) for label in labels], dtype='i8')
+
+    # Add samples. `condition_rows` gives each sample's row in self.counts and
+    # `t` its time from the epoch start (only needed with time bins).
+    def _accumulate(self, x, y, condition_rows, t=None):
+        bx = np.floor((x + self.screen_size[0] / 2) / self.bin_size)
+        by = np.floor((y + self.screen_size[1] / 2) / self.bin_size)
+        keep = (bx >= 0) & (bx < self.nx) & (by >= 0) & (by < self.ny)
+        if self.time_bins is None:
+            bt = np.zeros(len(x))
+        else:
+            bt = np.searchsorted(self.time_bins, t, side='right') - 1
+            keep &= (bt >= 0) & (bt < self.nt)
+        flat = ((condition_rows[keep] * self.nt + bt[keep].astype('i8')) * self.ny
+                + by[keep].astype('i8')) * self.nx + bx[keep].astype('i8')
+        self.counts += np.bincount(flat, minlength=self.counts.size).reshape(self.counts.shape)
+
+    # Add one session from its samples and trial index (see gaze_data) with one
+    # condition label per trial
+    def add_session(self, samples, index, trial_conditions, session=None):
+        if session is not None and session in self.sessions:
+            return False
+        rows = self._condition_rows(list(trial_conditions))
+        first, stop = gaze_data.epoch_bounds(samples['time'], index, *self.epoch)
+        valid = gaze_data.valid_samples(samples)
+        # Row and epoch start time of every sample, -1 outside the epochs
+        sample_rows = np.full(len(samples['time']), -1, dtype='i8')
+        sample_t0 = np.zeros(len(samples['time']))
+        for row, f, s, t0 in zip(rows, first, stop, index[self.epoch[0]]):
+            sample_rows[f:s] = row
+            sample_t0[f:s] = t0
+        keep = valid & (sample_rows >= 0)
+        self._accumulate(samples['gaze_x'][keep], samples['gaze_y'][keep], sample_rows[keep],
+                         samples['time'][keep] - sample_t0[keep])
+        # Only recorded once its samples are counted, so a failed add can be retried
+        if session is not None:
+            self.sessions.add(session)
+        return True
+
+    # Add a session from its iohub .hdf5 file and results csv, with the
+    # conditions taken from the `by` columns of the results. Sessions are
+    # recorded by name (the file name without .hdf5), so the same session is
+    # not added twice through another path to its file.
+    def add_session_files(self, hdf5_path, results_path, by=CONDITION_COLUMNS):
+        session = os.path.splitext(os.path.basename(hdf5_path))[0]
+        if session in self.sessions:
+            return False
+        samples = gaze_data.read_samples(hdf5_path)
+        index = gaze_data.trial_index(gaze_data.read_messages(hdf5_path))
+        results = pd.read_csv(results_path, index_col=0)
+        # Message categories are the row numbers of the saved trial list
+        design = results.reindex(index['trial'])
+        keep = design[list(by)].notna().all(axis=1).to_numpy()
+        labels = [tuple(str(v) for v in row) for row in design.loc[keep, list(by)].itertuples(index=False)]
+        return self.add_session(samples, index[keep], labels, session=session)
+
+    # Gaze density of a condition (per time bin), Gaussian smoothed with `sigma`
+    # pixels and normalised to sum to 1 in each time bin
+    def density(self, condition, sigma=25.0):
+        counts = self.counts[self.conditions.index(condition)]
+        smooth_x = _gaussian_matrix(self.nx, sigma / self.bin_size)
+        smooth_y = _gaussian_matrix(self.ny, sigma / self.bin_size)
+        smoothed = smooth_y @ counts @ smooth_x.T
+        totals = smoothed.sum(axis=(1, 2), keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            smoothed = np.where(totals > 0, smoothed / totals, 0.0)
+        return smoothed if self.time_bins is not None else smoothed[0]
+
+    def save(self, path):
+        np.savez_compressed(path, counts=self.counts,
+                            conditions=np.array([repr(c) for c in self.conditions]),
+                            sessions=np.array(sorted(self.sessions)),
+                            screen_size=self.screen_size, bin_size=self.bin_size,
+                            time_bins=np.array([]) if self.time_bins is None else self.time_bins,
+                            epoch=np.array(self.epoch))
+
+    @classmethod
+    def load(cls, path, max_bytes=512 * 2 ** 20):
+        import ast
+        with np.load(path) as saved:
+            time_bins = saved['time_bins'] if len(saved['time_bins']) else None
+            heatmap = cls(tuple(saved['screen_size']), int(saved['bin_size']), time_bins,
+                          tuple(saved['epoch']), max_bytes)
+            heatmap.conditions = [ast.literal_eval(c) for c in saved['conditions']]
+            heatmap.sessions = set(saved['sessions'].tolist())
+            heatmap.counts = saved['counts']
+        return heatmap
+
+
+# Matrix applying a Gaussian filter (in bins) along one axis, with the
+# weights renormalised at the edges
+def _gaussian_matrix(n, sigma):
+    positions = np.arange(n)
+    if sigma <= 0:
+        return np.eye(n)
+    weights = np.exp(-0.5 * ((positions[:, None] - positions[None, :]) / sigma) ** 2)
+    weights[weights < 1e-8] = 0.0
+    return weights / weights.sum(axis=1, keepdims=True)
@@ -0,0 +1,96 @@
+import csv
+import time
+from contextlib import contextmanager
+
+# Wall clock durations of named phases, e.g. imports and set-up steps of the
+# experiment script or the steps of each trial. Offsets are from `start`, so
+# pass the time taken at the very top of the script to include the interpreter
+# and import time. A disabled PhaseTimes records nothing and costs one
+# attribute check per phase.
+class PhaseTimes:
+    def __init__(self, start=None, enabled=True):
+        self.start = time.perf_counter() if start is None else start
+        self.enabled = enabled
+        # Label stored with each row, e.g. the trial number
+        self.trial = ''
+        self.rows = []
+        self._sampler = None
+
+    @contextmanager
+    def timed(self, phase):
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            t1 = time.perf_counter()
+            self.rows.append((self.trial, phase, t0 - self.start, t1 - t0))
+
+    # Mark a point in time (e.g. dialogue shown) without a duration
+    def mark(self, phase):
+        if self.enabled:
+            self.rows.append((self.trial, phase, time.perf_counter() - self.start, 0.0))
+
+    # Time every call of obj.<method> as `phase` by shadowing the method on the
+    # instance. Returns a function that puts the original method back.
+    def instrument(self, obj, method, phase):
+        original = getattr(obj, method)
+        if not self.enabled:
+            return lambda: None
+
+        def timed_call(*args, **kwargs):
+            with self.timed(phase):
+                return original(*args, **kwargs)
+
+        own = method in vars(obj)
+        setattr(obj, method, timed_call)
+
+        def restore():
+            if own:
+                setattr(obj, method, original)
+            else:
+                delattr(obj, method)
+        return restore
+
+    # Start a sampling profiler (pyinstrument, if installed) next to the timers
+    def start_sampler(self):
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("pyinstrument is not installed; only the phase timers are recorded.")
+            return
+        self._sampler = Profiler()
+        self._sampler.start()
+
+    # Stop the sampling profiler and save its report as html
+    def stop_sampler(self, path):
+        if self._sampler is None:
+            return
+        self._sampler.stop()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self._sampler.output_html())
+        self._sampler = None
+
+    # Count, total, mean and max duration (sec) of each phase
+    def summary(self):
+        phases = dict()
+        for trial, phase, offset, duration in self.rows:
+            phases.setdefault(phase, []).append(duration)
+        return {phase: (len(d), sum(d), sum(d) / len(d), max(d)) for phase, d in phases.items()}
+
+    def print_summary(self):
+        for trial, phase, offset, duration in self.rows:
+            print(f"{phase:<28} at {offset:8.3f} s  took {duration * 1000:9.1f} ms")
+
+    def print_phase_summary(self):
+        for phase, (count, total, mean, longest) in self.summary().items():
+            print(f"{phase:<28} {count:6d} calls  mean {mean * 1000:8.2f} ms  "
+                  f"max {longest * 1000:8.2f} ms  total {total:8.3f} s")
+
+    def write_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['trial', 'phase', 'offset_s', 'duration_s'])
+            writer.writerows(self.rows)
@@ -0,0 +1,118 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import traceback
+
+# Post-session export worker. The experiment script starts it as a detached
+# process once the iohub server has closed the session's .hdf5 file, so the
+# next participant does not have to wait for the export.
+#
+# Usage: python session_export.py <session>.hdf5
+#
+# Writes <session>.export_done (JSON with the files written) when finished, or
+# <session>.export_failed with the traceback if anything went wrong.
+
+# Same settings as the experiment script used for saveEventReport
+SAVE_EVENT_TYPE = 'MonocularEyeSampleEvent'
+SAVE_EVENT_FIELDS = None
+
+# The export can run while the next participant is recorded, so the worker
+# runs at a lower priority than the experiment (niceness added on Linux/macOS)
+EXPORT_NICENESS = 10
+
+# How long to wait for the iohub server to release the .hdf5 file
+DATASTORE_TIMEOUT = 60
+
+
+# Start the worker for one session without waiting for it, at below normal
+# priority so it does not compete with the experiment's frame timing
+def start_export(hdf5_path):
+    args = [sys.executable, os.path.abspath(__file__), os.path.abspath(hdf5_path)]
+    if sys.platform == 'win32':
+        flags = (subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+                 | subprocess.BELOW_NORMAL_PRIORITY_CLASS)
+        return subprocess.Popen(args, creationflags=flags, close_fds=True)
+    return subprocess.Popen(args, start_new_session=True, close_fds=True,
+                            stdin=subprocess.DEVNULL)
+
+
+# Wait until the datastore can be opened, i.e. the iohub server has flushed
+# and closed it
+def wait_for_datastore(hdf5_path, timeout=DATASTORE_TIMEOUT):
+    import tables
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with tables.open_file(hdf5_path, mode='r'):
+                return
+        except (OSError, tables.HDF5ExtError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+def export_session(hdf5_path):
+    import numpy as np
+    import pandas as pd
+    from psychopy.iohub.datastore.util import saveEventReport
+    import gaze_data
+
+    wait_for_datastore(hdf5_path)
+    base = os.path.splitext(hdf5_path)[0]
+    outputs = dict()
+
+    # Sample export (same as the experiment script used to do)
+    result = saveEventReport(hdf5FilePath=hdf5_path,
+                             eventType=SAVE_EVENT_TYPE,
+                             eventFields=SAVE_EVENT_FIELDS,
+                             trialStart=gaze_data.TRIAL_START,
+                             trialStop=gaze_data.TRIAL_END)
+    if not result:
+        raise RuntimeError("saveEventReport failed.")
+    file_saved, events_saved = result
+    outputs['events'] = file_saved
+    outputs['events_saved'] = events_saved
+
+    # Epoching: the samples as columns plus the trial index and epoch bounds
+    samples = gaze_data.read_samples(hdf5_path)
+    messages = gaze_data.read_messages(hdf5_path)
+    index = gaze_data.trial_index(messages)
+    first, stop = gaze_data.epoch_bounds(samples['time'], index)
+    epochs_path = base + '_epochs.npz'
+    np.savez(epochs_path, index=index, first=first, stop=stop, **samples)
+    outputs['epochs'] = epochs_path
+
+    # Per trial summaries
+    summary_path = base + '_trial_summary.csv'
+    pd.DataFrame(gaze_data.trial_summaries(samples, index)).to_csv(summary_path, index=False)
+    outputs['summary'] = summary_path
+    return outputs
+
+
+def main(hdf5_path):
+    base = os.path.splitext(hdf5_path)[0]
+    started = time.time()
+    try:
+        outputs = export_session(hdf5_path)
+    except Exception:
+        with open(base + '.export_failed', 'w') as f:
+            f.write(traceback.format_exc())
+        return 1
+    outputs['seconds'] = time.time() - started
+    # Write the marker under a temporary name first so it only ever appears complete
+    with open(base + '.export_done.tmp', 'w') as f:
+        json.dump(outputs, f, indent=2)
+    os.replace(base + '.export_done.tmp', base + '.export_done')
+    return 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python session_export.py <session>.hdf5")
+        sys.exit(2)
+    # On Windows the priority is set by start_export
+    if hasattr(os, 'nice'):
+        os.nice(EXPORT_NICENESS)
+    sys.exit(main(sys.argv[1]))
@@ -0,0 +1,139 @@
+import html
+import json
+import math
+import os
+import time
+
+# Live status of a running session for the experimenter: trials done, elapsed
+# and projected end time, track loss and fixation offset (drift) trends and
+# the questions answered. The experiment script calls update() once per trial
+# (after the question, before the next trial starts); the totals are kept as
+# running sums and the files are small, so an update takes about a millisecond.
+#
+# Writes <session>_status.json and <session>_status.html (reloads itself every
+# few seconds in a browser). Both are written under a temporary name and then
+# renamed, so a reader never sees a partly written file. The status is optional:
+# if a file cannot be written (e.g. on Windows while a browser has it open)
+# that update is skipped and the session carries on.
+
+# Number of recent trials the trends are computed over
+RECENT_TRIALS = 10
+# Browser reload interval of the html page (sec)
+REFRESH = 5
+
+
+def _mean(values):
+    values = [v for v in values if v is not None]
+    return sum(values) / len(values) if values else None
+
+
+# NaN -> None, so the json has null for trials without a value
+def _value(value):
+    return None if value is None or math.isnan(value) else float(value)
+
+
+def _write_atomic(path, text):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+
+class SessionStatus:
+    def __init__(self, session_info, n_trials):
+        self.base = session_info + '_status'
+        self.session_info = session_info
+        self.n_trials = n_trials
+        self.started = time.time()
+        self.trials_done = 0
+        self.questions = 0
+        self.correct = 0
+        self.scored = 0
+        self.rt_sum = 0.0
+        # Per trial values for the trends, and their running [sum, count]
+        self.track_loss = []
+        self.fixation_offset = []
+        self._totals = {'track_loss': [0.0, 0], 'fixation_offset': [0.0, 0]}
+        self.finished = False
+        self.write()
+
+    # Add a finished trial (a TrialRecord)
+    def update(self, record):
+        self.trials_done += 1
+        for name, value in (('track_loss', record.TrackLoss),
+                            ('fixation_offset', record.FixationOffset)):
+            value = _value(value)
+            getattr(self, name).append(value)
+            if value is not None:
+                self._totals[name][0] += value
+                self._totals[name][1] += 1
+        if record.Response is not None:
+            self.questions += 1
+            self.rt_sum += record.RT
+            if record.CorrectA is not None:
+                self.scored += 1
+                self.correct += record.Response == str(record.CorrectA).upper()
+        self.write()
+
+    def finish(self):
+        self.finished = True
+        self.write()
+
+    def _total_mean(self, name):
+        total, count = self._totals[name]
+        return total / count if count else None
+
+    def as_dict(self):
+        now = time.time()
+        elapsed = now - self.started
+        remaining = self.n_trials - self.trials_done
+        per_trial = elapsed / self.trials_done if self.trials_done else None
+        projected_end = now + remaining * per_trial if per_trial is not None else None
+        return {'session': self.session_info,
+                'finished': self.finished,
+                'updated': time.strftime('%H:%M:%S', time.localtime(now)),
+                'trials_done': self.trials_done,
+                'n_trials': self.n_trials,
+                'elapsed_min': elapsed / 60.0,
+                'projected_end': (time.strftime('%H:%M', time.localtime(projected_end))
+                                  if projected_end is not None else None),
+                'track_loss': self._total_mean('track_loss'),
+                'track_loss_recent': _mean(self.track_loss[-RECENT_TRIALS:]),
+                'fixation_offset': self._total_mean('fixation_offset'),
+                'fixation_offset_recent': _mean(self.fixation_offset[-RECENT_TRIALS:]),
+                'questions_shown': self.questions,
+                'proportion_correct': self.correct / self.scored if self.scored else None,
+                'mean_rt': self.rt_sum / self.questions if self.questions else None,
+                'track_loss_by_trial': self.track_loss,
+                'fixation_offset_by_trial': self.fixation_offset}
+
+    def write(self):
+        status = self.as_dict()
+        try:
+            _write_atomic(self.base + '.json', json.dumps(status, indent=1))
+            _write_atomic(self.base + '.html', self.to_html(status))
+        except OSError as error:
+            print(f"Status not updated ({error!r}).")
+
+    def to_html(self, status):
+        def fmt(value, spec):
+            return '-' if value is None else format(value, spec)
+
+        rows = [('Trials', f"{status['trials_done']} / {status['n_trials']}"),
+                ('Elapsed', f"{status['elapsed_min']:.1f} min"),
+                ('Projected end', status['projected_end'] or '-'),
+                ('Track loss (all / last %d)' % RECENT_TRIALS,
+                 f"{fmt(status['track_loss'], '.1%')} / {fmt(status['track_loss_recent'], '.1%')}"),
+                ('Fixation offset (all / last %d)' % RECENT_TRIALS,
+                 f"{fmt(status['fixation_offset'], '.0f')} / "
+                 f"{fmt(status['fixation_offset_recent'], '.0f')} pix"),
+                ('Questions shown', str(status['questions_shown'])),
+                ('Correct', fmt(status['proportion_correct'], '.0%')),
+                ('Mean RT', fmt(status['mean_rt'], '.2f') + ' s')]
+        table = '\n'.join(f"<tr><th>{html.escape(name)}</th><td>{html.escape(value)}</td></tr>"
+                          for name, value in rows)
+        refresh = '' if status['finished'] else f'<meta http-equiv="refresh" content="{REFRESH}">'
+        state = 'finished' if status['finished'] else 'running'
+        return (f"<!DOCTYPE html><html><head><meta charset=\"utf-8\">{refresh}"
+                f"<title>{html.escape(status['session'])}</title></head><body>"
+                f"<h1>{html.escape(status['session'])} ({state}, {status['updated']})</h1>"
+                f"<table>{table}</table></body></html>\n")
@@ -1,113 +1,78 @@
-from psychopy.gui import DlgFromDict
-from psychopy.visual import Window, TextStim, ImageStim
-from psychopy.core import Clock, quit, wait
-from psychopy.event import Mouse
-from psychopy.hardware.keyboard import Keyboard
-from psychopy import prefs, sound, core, event, data, visual, iohub
-from psychopy.iohub.client.eyetracker.validation import TargetStim
-from psychopy.iohub.client import launchHubServer, ioHubConnection, yload, yLoader
-from psychopy.iohub.util import hideWindow, showWindow
-from psychopy.iohub.datastore.util import saveEventReport
-from psychopy.visual.textbox import TextBox
-import pandas as pd
-import pylink as pl
-import os
-import random
-import csv
+import time
+# Taken before any other import so the startup profile includes import time
+SCRIPT_START = time.perf_counter()
+
+from profiling import PhaseTimes
+startup = PhaseTimes(start=SCRIPT_START)
+
+with startup.timed('import dialog'):
+    from psychopy.gui import DlgFromDict
+    from psychopy.core import Clock, quit, wait
+    from psychopy import prefs, core
+    import pandas as pd
+    import random
+    from session_export import start_export
+    from data_quality import TrialQuality, block_report
+    from aoi import AOIIndex
+    from trial_records import TrialStore
+    from session_status import SessionStatus
 
 # Set audio prefs
 prefs.hardware['audioLib'] = ['PTB', 'sounddevice', 'pyo', 'pygame']
 
-### DIALOGUE BOX ROUTINE ###
-
-exp_info = {'participant': 0, 
-            'subgroup': 0, 
-            'version': 0, 
-            'rotation': '',
-            'tracker (mouse/eyelink)': ''}
-dlg = DlgFromDict(exp_info, title='Experiment Setup', sortKeys=False)
-
-### DIALOGUE BOX ROUTINE END ###
-
-# If pressed Cancel, abort!
-if not dlg.OK:
-    quit()
-else:
-    # Quit when experiment info is not filled in or if invalid subgroup/version
-    if not exp_info['participant']:
-        quit()
-    if exp_info['subgroup'] > 2 or exp_info['version'] > 2:
-        print("Error: Invalid subgroup or version. Please select '1' or '2'.")
-        quit()
-    if exp_info['subgroup'] < 1 or exp_info['version'] < 1:
-        print("Error: Invalid subgroup or version. Please select '1' or '2'.")
-        quit()
-    else:  # Start the experiment!
-        print(f'''Started experiment for participant {exp_info['participant']},
-                 subgroup {exp_info['subgroup']},
-                    version {exp_info['version']}''')
-                 
-
-# Set the rotation type (male or female)
-rotation_type = exp_info['rotation']
-
-# Make subgroup and version strings for concatenation and saving
-part = str(exp_info['participant'])
-subgroup = str(exp_info['subgroup'])
-version = str(exp_info['version'])
-rotation = str(exp_info['rotation'])
-session_info = (f"{part}_sub{subgroup}_ver{version}_{rotation}")
-tracker_info = str(exp_info['tracker (mouse/eyelink)'])
+# The window, audio and iohub backends are slow to import, so they are only
+# loaded once the dialogue box is filled in. Tracker specific backends (e.g.
+# pylink for the EyeLink) are imported by iohub only for the configured tracker.
+visual = sound = Mouse = None
+launchHubServer = hideWindow = showWindow = TrackerSamples = TextCache = None
+
+def load_backends():
+    global visual, sound, Mouse, launchHubServer, hideWindow, showWindow, TrackerSamples, TextCache
+    from psychopy import visual, sound
+    from psychopy.event import Mouse
+    from psychopy.iohub.client import launchHubServer
+    from tracker_samples import TrackerSamples
+    from text_cache import TextCache
+    from psychopy.iohub.util import hideWindow, showWindow
+
+# Print the startup profile and save it as <session>_startup.csv
+STARTUP_PROFILE = True
+
+# Time each step of the practice and main trials (stim and sound set-up, iohub
+# and EDF messages, recording on/off, clearing events, flips) and save the
+# times as <session>_profile.csv. With PROFILE_SAMPLER a pyinstrument
+# sampling profile is saved as <session>_profile.html as well.
+PROFILE_TRIALS = False
+PROFILE_SAMPLER = False
+
+# Continuous recording: record once per block (practice, and main trials
+# between breaks) instead of starting and stopping the tracker every trial.
+# Trials are then only delimited by the message events, which the offline
+# trial index (gaze_data.trial_index) uses anyway.
+CONTINUOUS_RECORDING = False
+
+# Keep recording through the question screen of the main trials and store the
+# time spent looking at the question and at each answer option (DwellQuestion,
+# DwellTrue, DwellFalse columns; see aoi.py)
+RECORD_QUESTIONS = False
+trial_profile = PhaseTimes(enabled=False)
+
+# Session runner mode: keep the window, text stims and audio backend open and
+# run consecutive participants from one process. Only the iohub server (and so
+# the session_code/.hdf5 datastore file) and calibration are redone per session.
+# Cancel the dialogue box to finish the day.
+SESSION_RUNNER = False
+
+# Folder of the cached text renderings (see text_cache.py); None renders all
+# text live every session
+TEXT_CACHE_DIR = 'text_cache'
+
+# Keep <session>_status.json/.html up to date with the progress and data
+# quality of the main trials (see session_status.py)
+STATUS_FILE = True
 
-### EYE TRACKER SETUP ###
-
-# Eye tracker to use ('mouse', 'eyelink', 'gazepoint', or 'tobii')
-TRACKER = tracker_info
 BACKGROUND_COLOR = [128, 128, 128]
 
-devices_config = dict()
-eyetracker_config = dict(name='tracker')
-if TRACKER == 'mouse':
-    eyetracker_config['calibration'] = dict(screen_background_color=BACKGROUND_COLOR)
-    devices_config['eyetracker.hw.mouse.EyeTracker'] = eyetracker_config
-elif TRACKER == 'eyelink':
-    eyetracker_config['model_name'] = 'EYELINK 1000 DESKTOP'
-    eyetracker_config['runtime_settings'] = dict(sampling_rate=1000, track_eyes=' ')
-    eyetracker_config['calibration'] = dict(screen_background_color=BACKGROUND_COLOR)
-    devices_config['eyetracker.hw.sr_research.eyelink.EyeTracker'] = eyetracker_config
-elif TRACKER == 'gazepoint':
-    eyetracker_config['calibration'] = dict(use_builtin=False, screen_background_color=BACKGROUND_COLOR)
-    devices_config['eyetracker.hw.gazepoint.gp3.EyeTracker'] = eyetracker_config
-elif TRACKER == 'tobii':
-    eyetracker_config['calibration'] = dict(screen_background_color=BACKGROUND_COLOR)
-    devices_config['eyetracker.hw.tobii.EyeTracker'] = eyetracker_config
-else:
-    print("{} is not a valid TRACKER name; please use 'mouse', 'eyelink', 'gazepoint', or 'tobii'.".format(TRACKER))
-    core.quit()
-
-win = visual.Window((1280, 1024),
-                    units='pix',
-                    fullscr=True,
-                    allowGUI=False,
-                    colorSpace='rgb255',
-                    monitor='sls_Dell',
-                    color=BACKGROUND_COLOR,
-                    screen=0
-                    )
-
-                    
-io = launchHubServer(window=win, 
-                    **devices_config, 
-                    experiment_code='sex_stereo',
-                    session_code=session_info)
-                
-# Specify the iohub .hdf5 file to process. None will prompt for file selection when script is run.
-IOHUB_DATA_FILE = session_info+'.hdf5'
-# Specify which event type to save. Setting to None will prompt to select an event table
-SAVE_EVENT_TYPE = 'MonocularEyeSampleEvent' # 'MonocularEyeSampleEvent'
-# Specify which event fields to save. Setting to None will save all event fields.
-SAVE_EVENT_FIELDS = None # ['time', 'gaze_x', 'gaze_y', 'pupil_measure1', 'status']
-
 # Specify the experiment message text used to split events into trial periods.
 # Set both to None to save all events.
 TRIAL_START = 'trial_start' #'text.started' #  'target.started'
@@ -120,42 +85,19 @@ PRACTICE_END = 'practice_end'
 PRACTICETARG_START = 'practice_targ_start'
 
 # Start of the audio
-TARGET_START = 'target_start' 
-
-# Get some iohub devices for future access.
-keyboard = io.getDevice('keyboard')
-tracker = io.getDevice('tracker')
-
-# Calibration
-# Minimize the PsychoPy window if needed
-hideWindow(win)
-# Display calibration gfx window and run calibration.
-result = tracker.runSetupProcedure()
-print("Calibration returned: ", result)
-# Maximize the PsychoPy window if needed
-showWindow(win)
-
-### EYE TRACKER SETUP END ###
+TARGET_START = 'target_start'
 
-# Initialize a mouse set to invisible
-mouse = Mouse(visible=False)
-# Initialize a (global) clock
-clock = Clock()
-# Initialize a (trial) clock
-trial_clock = Clock()
-# Initialize Keyboard
-kb = Keyboard()
+# Question screen shown and answered (RECORD_QUESTIONS)
+QUESTION_START = 'question_start'
+QUESTION_END = 'question_end'
 
-# Create trial lists based on session info
-def trial_list_reader(subgroup,version,rotation):
-    trial_list_path = 'stim_lists/subgroup'+subgroup+'version'+version+'_'+rotation+'.csv'
-    trial_list = pd.read_csv(trial_list_path)
-    return trial_list
-    
-trial_list = trial_list_reader(subgroup,version,rotation)
+# Audio directories
+prime_folder = '../primes'
+target_folder = '../targets'
 
-# Shuffle rows in the trial_list using pandas sample (frac=1 is 100% of rows)
-trial_list = trial_list.sample(frac = 1)
+# Setup paths to practice files
+practice_female = 'stim_lists/practice_female.csv'
+practice_male = 'stim_lists/practice_male.csv'
 
 # Create all possible orders for 1 - 4
 # Randomly select one to sort by
@@ -185,50 +127,6 @@ orderDict = {'1': [1,2,3,4],
              '23': [4,3,1,2],
              '24': [4,3,2,1]
              }
-             
-# Select a number from 1 - 24 to use as a key to select an order
-orderNum = random.randint(1,24)
-# Define order sequence
-orderSeq = orderDict[f'{orderNum}']
-
-# Convert Section to categorical and use orderSeq to sort
-trial_list['Section'] = pd.Categorical(trial_list['Section'], categories=orderSeq, ordered=True)
-
-# Sort the frame based on Section and reset index
-trial_list = trial_list.sort_values(by='Section').reset_index()
-
-# Setup paths to practice files
-practice_female = 'stim_lists/practice_female.csv'
-practice_male = 'stim_lists/practice_male.csv'
-
-# Practice trials
-if rotation == 'f':
-    practice_trials = pd.read_csv(practice_female)
-if rotation == 'm':
-    practice_trials = pd.read_csv(practice_male)
-if rotation == 'test':
-    practice_trials = pd.read_csv(practice_female)
-
-# Shuffle rows
-practice_trials = practice_trials.sample(frac = 1).reset_index()
-
-# Extract values to list for each column for practice
-practice_id_list = practice_trials['ID'].tolist()
-practice_prime_list = practice_trials['Prime'].tolist()
-practice_target_list = practice_trials['Target'].tolist()
-practice_question_list = practice_trials['Question'].tolist()
-
-# Main trials
-# Extract values to list for each column for trial_list
-section_list = trial_list['Section'].tolist()
-id_list = trial_list['ID'].tolist()
-prime_list = trial_list['Prime'].tolist()
-target_list = trial_list['Target'].tolist()
-question_list = trial_list['Question'].tolist()
-
-# Audio directories
-prime_folder = '../primes'
-target_folder = '../targets'
 
 # Instructions
 
@@ -276,295 +174,631 @@ continue_text = '如果您准备好开始主要实验，请按enter。'
 thankYou = '''The experiment is complete. Thank you for taking part!
 Please press 'enter' to end the experiment.'''
 
-### START BODY OF EXPERIMENT ###
+### DIALOGUE BOX ROUTINE ###
 
-# Set up all of the display text except the question stims (in main trial loop)
-welcome_txt_stim = TextStim(win, color=(0.8,1.0,0.5), font='Calibri', units='norm', text="Welcome to this experiment!")
-
-if rotation == 'f':
-    instruct_txt_stim = TextStim(win, color=(0.8,1.0,0.5), font='SimSun', units='norm',text=instructions_female, alignText='center')
-if rotation == 'm':
-    instruct_txt_stim = TextStim(win, color=(0.8,1.0,0.5), font='SimSun', units='norm',text=instructions_male, alignText='center')
-if rotation == 'test':
-    instruct_txt_stim = TextStim(win, color=(0.8,1.0,0.5), font='SimSun', units='norm',text=instructions_female, alignText='center')
-    
-true_false_stim1 = TextStim(win, color=(0.8,1.0,0.5), font='SimSun', units='norm', text=true_false_text1, alignText='center', pos=(0, -0.2))
-true_false_stim2 = TextStim(win, color=(0.8,1.0,0.5), font='SimSun', units='norm', text=true_false_text2, alignText='center', pos=(0, -0.2))
-
-practice_end_stim = TextStim(win, color=(0.8,1.0,0.5), font='SimSun', units='norm', text=practiceEnd, alignText='center')
-thankYou_txt_stim = TextStim(win, color=(0.8,1.0,0.5), font='Calibri', units='norm', text=thankYou, alignText='center')
-fixation = TextStim(win, color=(0.8,1.0,0.5), units='norm', font='Calibri', text="+")
-continue_message = TextStim(win, color=(0.8,1.0,0.5), font='SimSun', units='norm', text=continue_text, alignText='center')
-
-fixation_cross = visual.ShapeStim(
-    win=win, name='polygon', vertices='cross',
-    size=(30, 30),
-    ori=0.0, pos=(0, 0), anchor='center',
-    lineWidth=1.0, colorSpace='rgb', lineColor='white', fillColor='white',
-    opacity=None, depth=0.0, interpolate=True)
-
-# Welcome window
-welcome_txt_stim.draw()
-win.flip()
-wait(3)
-
-### INSTRUCTIONS ROUTINE ###
-
-while True:
-    instruct_txt_stim.draw()
-    win.flip()
-    keys = kb.getKeys()
-    contKey = event.waitKeys()
-    if 'return' in contKey:
+# Ask for the session info until it is valid. Returns None if cancelled.
+def session_dialog():
+    exp_info = {'participant': 0,
+                'subgroup': 0,
+                'version': 0,
+                'rotation': '',
+                'tracker (mouse/eyelink)': ''}
+    while True:
+        # The dialogue box keeps the values entered last time
+        dlg = DlgFromDict(exp_info, title='Experiment Setup', sortKeys=False)
+
+        # If pressed Cancel, abort!
+        if not dlg.OK:
+            return None
+        # Ask again when experiment info is not filled in or not valid
+        if not exp_info['participant']:
+            print("Error: Please enter the participant number.")
+            continue
+        if not (1 <= exp_info['subgroup'] <= 2 and 1 <= exp_info['version'] <= 2):
+            print("Error: Invalid subgroup or version. Please select '1' or '2'.")
+            continue
+        if exp_info['rotation'] not in ('f', 'm', 'test'):
+            print("Error: Invalid rotation. Please enter 'f', 'm' or 'test'.")
+            continue
+        if eyetracker_devices(str(exp_info['tracker (mouse/eyelink)'])) is None:
+            continue
         break
+    # Start the experiment!
+    print(f'''Started experiment for participant {exp_info['participant']},
+             subgroup {exp_info['subgroup']},
+                version {exp_info['version']}''')
+    return exp_info
 
-### INSTRUCTIONS ROUTINE END ###
+### DIALOGUE BOX ROUTINE END ###
 
-### PRACTICE ROUTINE ###
+### EYE TRACKER SETUP ###
 
-# Iterate over the trials based on rotation
-practice = enumerate(zip(practice_id_list, practice_prime_list, practice_target_list, practice_question_list))
-
-for index, (ID, Prime, Target, Question) in practice:
-    interest_region = visual.Circle(win, lineColor=None, radius=200, units='pix')
-    io.clearEvents()
-    prac_num = str(index)
-    tracker.setRecordingState(True)
-    io.sendMessageEvent(text=PRACTICE_START, category=prac_num)
-    # Send EDF message
-    tracker.sendMessage('Practice_Start')
-    # Draw the fixation
-    win.flip()
-    clock.reset()
-    # Get the latest gaze position
-    gpos = tracker.getLastGazePosition()
-    tracker.getLastSample()
-    # Set up stims
-    current_prime = os.path.join(prime_folder, Prime)
-    prime_stim = sound.Sound(current_prime)
-    prime_stim.play()
-    core.wait(prime_stim.getDuration())
-    trial_clock.reset()
-    win.flip()
-    # Fixation cross
-    io.sendMessageEvent(text=FIXATION_START, category=prac_num)
-    tracker.sendMessage('Fixation_Start')
-    fixation_cross.draw()
-    win.flip()
-    core.wait(1.5)
-    current_target = os.path.join(target_folder, Target)
-    target_stim = sound.Sound(current_target)
-    # Play the target audio
-    io.sendMessageEvent(text=PRACTICETARG_START, category=prac_num)
-    # Send EDF message
-    tracker.sendMessage('PracticeTarg_Start')
-    target_stim.play()
-    core.wait(target_stim.getDuration())
-    core.wait(2.7)
-    trial_clock.reset()
-    # Get pupil and other info
-    tracker.getLastSample()
-    io.sendMessageEvent(text=PRACTICE_END, category=prac_num)
-    # Send EDF message
-    tracker.sendMessage('Practice_End')
-    tracker.setRecordingState(False)
-    win.flip()
-    core.wait(1)
-    # Set up question
-    current_question = Question
+# Eye tracker to use ('mouse', 'eyelink', 'gazepoint', or 'tobii')
+def eyetracker_devices(TRACKER):
+    devices_config = dict()
+    eyetracker_config = dict(name='tracker')
+    if TRACKER == 'mouse':
+        eyetracker_config['calibration'] = dict(screen_background_color=BACKGROUND_COLOR)
+        devices_config['eyetracker.hw.mouse.EyeTracker'] = eyetracker_config
+    elif TRACKER == 'eyelink':
+        eyetracker_config['model_name'] = 'EYELINK 1000 DESKTOP'
+        eyetracker_config['runtime_settings'] = dict(sampling_rate=1000, track_eyes=' ')
+        eyetracker_config['calibration'] = dict(screen_background_color=BACKGROUND_COLOR)
+        devices_config['eyetracker.hw.sr_research.eyelink.EyeTracker'] = eyetracker_config
+    elif TRACKER == 'gazepoint':
+        eyetracker_config['calibration'] = dict(use_builtin=False, screen_background_color=BACKGROUND_COLOR)
+        devices_config['eyetracker.hw.gazepoint.gp3.EyeTracker'] = eyetracker_config
+    elif TRACKER == 'tobii':
+        eyetracker_config['calibration'] = dict(screen_background_color=BACKGROUND_COLOR)
+        devices_config['eyetracker.hw.tobii.EyeTracker'] = eyetracker_config
+    else:
+        print("{} is not a valid TRACKER name; please use 'mouse', 'eyelink', 'gazepoint', or 'tobii'.".format(TRACKER))
+        return None
+    return devices_config
+
+# Calibration
+def calibrate(win, tracker):
+    # Minimize the PsychoPy window if needed
+    hideWindow(win)
+    # Display calibration gfx window and run calibration.
+    result = tracker.runSetupProcedure()
+    print("Calibration returned: ", result)
+    # Maximize the PsychoPy window if needed
+    showWindow(win)
+
+# Start the iohub server for one session and run the calibration
+def start_tracker(win, devices_config, session_info):
+    with startup.timed('launch iohub'):
+        io = launchHubServer(window=win,
+                            **devices_config,
+                            experiment_code='sex_stereo',
+                            session_code=session_info)
+
+    # Get the tracker device for future access.
+    tracker = io.getDevice('tracker')
+
+    startup.mark('calibration start')
+    calibrate(win, tracker)
+    startup.mark('calibration end')
+    if STARTUP_PROFILE:
+        startup.print_summary()
+        startup.write_csv(session_info+'_startup.csv')
+    return io, tracker
+
+### EYE TRACKER SETUP END ###
+
+# Collect key presses from the iohub keyboard device. Keep drawing the given
+# stims and poll once per frame so the display never blocks on the keyboard.
+# Press times are iohub timestamps, i.e. the same clock as the eye samples.
+# Returns the key, the press time and the onset of the first frame shown.
+# With `samples` (a TrackerSamples) the eye samples are fetched every frame.
+def wait_for_keys(io, win, keyList, stims=(), samples=None):
+    keyboard = io.devices.keyboard
+    keyboard.clearEvents()
+    onset = None
+    while True:
+        for stim in stims:
+            stim.draw()
+        win.flip()
+        if onset is None:
+            onset = io.getTime()
+        if samples is not None:
+            samples.poll()
+        presses = keyboard.getPresses(keys=keyList)
+        if presses:
+            return presses[0].key, presses[0].time, onset
+
+# How often (sec) new eye samples are fetched while waiting in a trial
+SAMPLE_POLL_INTERVAL = 0.01
+
+# Wait for `duration` sec while feeding the new eye samples (a TrackerSamples)
+# to `quality` in batches. A zero duration just fetches the samples received so far.
+def stream_samples(samples, quality, duration):
+    deadline = core.getTime() + duration
+    while True:
+        quality.add_samples(samples.read_new())
+        remaining = deadline - core.getTime()
+        if remaining <= 0:
+            return
+        core.wait(min(remaining, SAMPLE_POLL_INTERVAL))
+
+# Create trial lists based on session info
+def trial_list_reader(subgroup,version,rotation):
+    trial_list_path = 'stim_lists/subgroup'+subgroup+'version'+version+'_'+rotation+'.csv'
+    trial_list = pd.read_csv(trial_list_path)
+    return trial_list
+
+# Shuffle the trial list and sort it into a random order of Sections
+def make_trial_list(subgroup,version,rotation):
+    trial_list = trial_list_reader(subgroup,version,rotation)
+
+    # Shuffle rows in the trial_list using pandas sample (frac=1 is 100% of rows)
+    trial_list = trial_list.sample(frac = 1)
+
+    # Select a number from 1 - 24 to use as a key to select an order
+    orderNum = random.randint(1,24)
+    # Define order sequence
+    orderSeq = orderDict[f'{orderNum}']
+
+    # Convert Section to categorical and use orderSeq to sort
+    trial_list['Section'] = pd.Categorical(trial_list['Section'], categories=orderSeq, ordered=True)
+
+    # Sort the frame based on Section and reset index
+    trial_list = trial_list.sort_values(by='Section').reset_index()
+    return trial_list
+
+# Practice trials
+def make_practice_trials(rotation):
+    if rotation == 'f':
+        practice_trials = pd.read_csv(practice_female)
+    if rotation == 'm':
+        practice_trials = pd.read_csv(practice_male)
+    if rotation == 'test':
+        practice_trials = pd.read_csv(practice_female)
+
+    # Shuffle rows
+    practice_trials = practice_trials.sample(frac = 1).reset_index()
+    return practice_trials
+
+### START BODY OF EXPERIMENT ###
+
+# Wrap width (norm) of the question and answer option text. The default of 1
+# (640 pix) would wrap the option strip and the longer questions (up to 21
+# em, about 1080 pix), so the question screen dwell could not tell the
+# options apart (see aoi.py).
+QUESTION_WRAP_WIDTH = 1.9
+
+# Settings of the question stims (text added in the trial loops)
+QUESTION_STIM = dict(font='SimSun', wrapWidth=QUESTION_WRAP_WIDTH)
+
+# Settings of all of the display text except the question stims
+TEXT_STIMS = {'welcome': dict(font='Calibri', text="Welcome to this experiment!"),
+              'instruct_f': dict(font='SimSun', text=instructions_female),
+              'instruct_m': dict(font='SimSun', text=instructions_male),
+              'true_false1': dict(font='SimSun', text=true_false_text1, pos=(0, -0.2),
+                                  wrapWidth=QUESTION_WRAP_WIDTH),
+              'true_false2': dict(font='SimSun', text=true_false_text2, pos=(0, -0.2),
+                                  wrapWidth=QUESTION_WRAP_WIDTH),
+              'practice_end': dict(font='SimSun', text=practiceEnd),
+              'thank_you': dict(font='Calibri', text=thankYou),
+              'continue': dict(font='SimSun', text=continue_text),
+              'break': dict(font='SimSun', text=break_text)
+              }
+
+# Display stims by name. Each stim is only built the first time it is used, so
+# rarely shown screens (breaks, thank you) do not delay the start. The stims
+# only depend on the window, so in session runner mode they are built once.
+# Text comes from the text cache when there is one.
+class LazyStims(dict):
+    def __init__(self, win):
+        super().__init__()
+        self.win = win
+        self.cache = TextCache(TEXT_CACHE_DIR, win) if TEXT_CACHE_DIR else None
+
+    # TextStim settings in the style of the experiment's text (e.g. the questions)
+    @staticmethod
+    def _styled(params):
+        return dict(color=(0.8,1.0,0.5), units='norm', alignText='center', **params)
+
+    # Text stim in the style of the experiment's text
+    def text(self, **params):
+        params = self._styled(params)
+        if self.cache is None:
+            return visual.TextStim(self.win, **params)
+        return self.cache.stim(**params)
+
+    # Render the texts not cached yet (all TEXT_STIMS and the given questions)
+    # so that nothing is rendered or written to the cache during the trials
+    def prepare(self, questions):
+        if self.cache is None:
+            return
+        texts = [self._styled(params) for params in TEXT_STIMS.values()]
+        texts += [self._styled(dict(QUESTION_STIM, text=question))
+                  for question in dict.fromkeys(questions) if isinstance(question, str)]
+        added = self.cache.fill(texts)
+        if added:
+            print(f"{added} texts added to the text cache.")
+
+    def __missing__(self, name):
+        if name == 'fixation_cross':
+            stim = visual.ShapeStim(
+                win=self.win, name='polygon', vertices='cross',
+                size=(30, 30),
+                ori=0.0, pos=(0, 0), anchor='center',
+                lineWidth=1.0, colorSpace='rgb', lineColor='white', fillColor='white',
+                opacity=None, depth=0.0, interpolate=True)
+        else:
+            stim = self.text(**TEXT_STIMS[name])
+        self[name] = stim
+        return stim
+
+# Areas of interest of a question screen: the question and the true and
+# false options of the label strip (split at the '|'). If the strip was
+# wrapped the options have no areas, so DwellTrue/DwellFalse are not saved.
+def question_aois(question_stim, true_false_stim, left_answer):
+    right_answer = 'FALSE' if left_answer == 'TRUE' else 'TRUE'
+    aois = AOIIndex(screen_size=tuple(question_stim.win.size))
+    aois.add_text(question_stim, 'DwellQuestion')
+    bar = true_false_stim.text.index('|')
+    labels = ['Dwell' + (left_answer if i < bar else right_answer).title()
+              for i in range(len(true_false_stim.text))]
+    if not aois.add_text(true_false_stim, None, labels):
+        print("The answer options are wrapped; their dwell is not recorded.")
+    return aois
+
+# Show the question (1/3 chance) and record the response in the trial record.
+# With `samples` (a TrackerSamples, recording on) the dwell on the question
+# and each option is recorded as well.
+def run_question(io, win, stims, record, tracker=None, samples=None):
     # Create 1/3 chance of question
     # This checks whether the random number is 2 (show question)
     question_num = random.randint(1,3)
     if question_num == 2:
-        question_stim = TextStim(win, color=(0.8,1.0,0.5), font='SimSun', units='norm', text=Question, alignText='center')
-        question_stim.draw()
+        with trial_profile.timed('question stim'):
+            question_stim = stims.text(text=record.Question, **QUESTION_STIM)
         true_false_num = random.randint(1,2)
+        true_false_stim = stims['true_false1'] if true_false_num == 1 else stims['true_false2']
+        if samples is not None:
+            io.sendMessageEvent(text=QUESTION_START, category=str(record.index))
+            tracker.sendMessage('Question_Start')
         if true_false_num == 1:
-            true_false_stim1.draw()
-            win.flip()
             # Check which key was pressed and record response
-            keys = event.waitKeys(keyList=["left", "right", "q"])
-            if "left" in keys:
-                practice_trials.loc[index, "Response"] = "FALSE"
-            elif "right" in keys:
-                practice_trials.loc[index, "Response"] = "TRUE"
-            elif "q" in keys:
+            key, press_time, onset = wait_for_keys(io, win, ["left", "right", "q"], [question_stim, stims['true_false1']], samples)
+            if key == "left":
+                record.Response = "FALSE"
+            elif key == "right":
+                record.Response = "TRUE"
+            elif key == "q":
                 core.quit()
         else:
-            true_false_stim2.draw()
-            win.flip()
-            keys = event.waitKeys(keyList=["left", "right", "q"])
-            if "left" in keys:
-                practice_trials.loc[index, "Response"] = "TRUE"
-            elif "right" in keys:
-                practice_trials.loc[index, "Response"] = "FALSE"
-            elif "q" in keys:
+            key, press_time, onset = wait_for_keys(io, win, ["left", "right", "q"], [question_stim, stims['true_false2']], samples)
+            if key == "left":
+                record.Response = "TRUE"
+            elif key == "right":
+                record.Response = "FALSE"
+            elif key == "q":
                 core.quit()
+        # Question onset and key press are both on the iohub (eye sample) clock
+        record.QuestionOnset = onset
+        record.ResponseTime = press_time
+        record.RT = press_time - onset
+        if samples is not None:
+            io.sendMessageEvent(text=QUESTION_END, category=str(record.index))
+            tracker.sendMessage('Question_End')
+            screen = samples.read_samples_since(onset)
+            screen = {name: column[screen['time'] <= press_time] for name, column in screen.items()}
+            aois = question_aois(question_stim, true_false_stim, 'FALSE' if true_false_num == 1 else 'TRUE')
+            record.update(aois.dwell(screen))
     win.flip()
     core.wait(1)
-    
-    
-while True:
-    practice_end_stim.draw()
-    win.flip()
-    contKey = event.waitKeys()
-    if 'return' in contKey:
-        # Continue to main trials
-        break
+
+### PRACTICE ROUTINE ###
+
+def run_practice(io, tracker, win, stims, practice_trials, clock, trial_clock):
+    if CONTINUOUS_RECORDING:
+        tracker.setRecordingState(True)
+
+    # Iterate over the trials based on rotation
+    for record in practice_trials:
+        index = record.index
+        with trial_profile.timed('stim construction'):
+            interest_region = visual.Circle(win, lineColor=None, radius=200, units='pix')
+        io.clearEvents()
+        prac_num = str(index)
+        trial_profile.trial = 'practice ' + prac_num
+        if not CONTINUOUS_RECORDING:
+            tracker.setRecordingState(True)
+        io.sendMessageEvent(text=PRACTICE_START, category=prac_num)
+        # Send EDF message
+        tracker.sendMessage('Practice_Start')
+        # Draw the fixation
+        win.flip()
+        clock.reset()
+        # Get the latest gaze position
+        gpos = tracker.getLastGazePosition()
+        tracker.getLastSample()
+        # Set up stims
+        with trial_profile.timed('sound load'):
+            prime_stim = sound.Sound(record.prime_path)
+        prime_stim.play()
+        core.wait(prime_stim.getDuration())
+        trial_clock.reset()
+        win.flip()
+        # Fixation cross
+        io.sendMessageEvent(text=FIXATION_START, category=prac_num)
+        tracker.sendMessage('Fixation_Start')
+        stims['fixation_cross'].draw()
+        win.flip()
+        core.wait(1.5)
+        with trial_profile.timed('sound load'):
+            target_stim = sound.Sound(record.target_path)
+        # Play the target audio
+        io.sendMessageEvent(text=PRACTICETARG_START, category=prac_num)
+        # Send EDF message
+        tracker.sendMessage('PracticeTarg_Start')
+        target_stim.play()
+        core.wait(target_stim.getDuration())
+        core.wait(2.7)
+        trial_clock.reset()
+        # Get pupil and other info
+        tracker.getLastSample()
+        io.sendMessageEvent(text=PRACTICE_END, category=prac_num)
+        # Send EDF message
+        tracker.sendMessage('Practice_End')
+        if not CONTINUOUS_RECORDING:
+            tracker.setRecordingState(False)
+        win.flip()
+        core.wait(1)
+        # Set up question
+        run_question(io, win, stims, record)
+
+    if CONTINUOUS_RECORDING:
+        tracker.setRecordingState(False)
+
+    # Continue to main trials
+    wait_for_keys(io, win, ['return'], [stims['practice_end']])
 
 ### PRACTICE ROUTINE END ###
 
 ### MAIN EXPERIMENT ROUTINE ###
 
-# Set break numbers by trial counter for main and test runs
-
-if rotation == 'f' or rotation == 'm':
-    break1 = 26
-    break2 = 51
-    break3 = 76
-if rotation == 'test':
-    break1 = 4
-    break2 = 7
-    break3 = 10
-
-# Iterate over the trials based on rotation
-trials = enumerate(zip(section_list, id_list, prime_list, target_list, question_list))
-trial = 0
-
-for index, (Section, ID, Prime, Target, Question) in trials:
-    interest_region = visual.Circle(win, lineColor=None, radius=200, units='pix')
-    trial_num = str(index)
-    trial += 1
-    trial_list.loc[index, "Trial"] = trial
-    io.clearEvents()
-    contKey = []
-    if trial == break1 or trial == break2 or trial == break3 and '1' not in contKey:
-        break_message = TextStim(win, color=(0.8,1.0,0.5), font='SimSun', units='norm', text=break_text, alignText='center')
-        break_message.draw()
+def run_trials(io, tracker, win, stims, trial_list, rotation, clock, trial_clock, status=None):
+    # Set break numbers by trial counter for main and test runs
+
+    if rotation == 'f' or rotation == 'm':
+        break1 = 26
+        break2 = 51
+        break3 = 76
+    if rotation == 'test':
+        break1 = 4
+        break2 = 7
+        break3 = 10
+
+    # Main trials
+    trial = 0
+    # Data quality of the trials since the last break
+    block_quality = []
+    # Whether the tracker is recording (continuous recording mode)
+    recording = False
+    # Eye samples of the current trial, the same columns for every tracker.
+    # They are only kept (rather than just passed on to the data quality) when
+    # the question screen dwell is recorded.
+    samples = TrackerSamples(tracker, keep=RECORD_QUESTIONS)
+
+    # Iterate over the trials based on rotation
+    for record in trial_list:
+        index = record.index
+        with trial_profile.timed('stim construction'):
+            interest_region = visual.Circle(win, lineColor=None, radius=200, units='pix')
+        trial_num = str(index)
+        trial_profile.trial = trial_num
+        trial += 1
+        record.Trial = trial
+        io.clearEvents()
+        contKey = []
+        if trial == break1 or trial == break2 or trial == break3 and '1' not in contKey:
+            # End of a block
+            if recording:
+                tracker.setRecordingState(False)
+                recording = False
+            # Tell the experimenter how good the data was since the last break
+            report = block_report(block_quality)
+            block_quality = []
+            print(f"Trials up to {trial - 1}: track loss {report['TrackLoss']:.1%}, "
+                  f"precision {report['PrecisionRMS']:.1f} pix, "
+                  f"fixation offset {report['FixationOffset']:.1f} pix")
+            if report['recalibrate']:
+                print("Recalibration advised. Press 'c' to recalibrate or '1' to continue.")
+            key, press_time, onset = wait_for_keys(io, win, ["1", "c"], [stims['break']])
+            if key == 'c':
+                calibrate(win, tracker)
+                key = '1'
+            contKey = [key]
+        # Run drift check if a break has occurred
+        if '1' in contKey:
+            # Show cross for drift check
+            wait_for_keys(io, win, ["return"], [stims['fixation_cross']])
+            # Maximize the PsychoPy window
+            win.flip()
+            core.wait(1)
+            # Continue to main trials
+            wait_for_keys(io, win, ["return"], [stims['continue']])
+        if not CONTINUOUS_RECORDING:
+            tracker.setRecordingState(True)
+        elif not recording:
+            # Start of a block; drop anything received before the recording started
+            tracker.setRecordingState(True)
+            recording = True
+            io.clearEvents()
+        samples.clear()
+        quality = TrialQuality(target=stims['fixation_cross'].pos)
         win.flip()
-        contKey = event.waitKeys(keyList=["1"])
-    # Run drift check if a break has occurred
-    if '1' in contKey:
-        # Show cross for drift check
-        fixation_cross.draw()
+        clock.reset()
+        trial_clock.reset()
+        io.sendMessageEvent(text=TRIAL_START, category=trial_num)
+        # Send EDF message
+        tracker.sendMessage('Trial_Start')
+        # Get the latest gaze position
+        gpos = tracker.getLastGazePosition()
+        tracker.getLastSample()
+        # Set up stim
+        with trial_profile.timed('sound load'):
+            prime_stim = sound.Sound(record.prime_path)
+        prime_stim.play()
+        stream_samples(samples, quality, prime_stim.getDuration())
+        trial_clock.reset()
         win.flip()
-        contKey = event.waitKeys(keyList=["return"])
-        # Maximize the PsychoPy window
+        # Draw the fixation
+        io.sendMessageEvent(text=FIXATION_START, category=trial_num)
+        # Send EDF message
+        io.sendMessageEvent(text=FIXATION_START, category=trial_num)
+        tracker.sendMessage('Fixation_Start')
+        stims['fixation_cross'].draw()
+        win.flip()
+        fixation_onset = io.getTime()
+        quality.set_fixation(fixation_onset, fixation_onset + 1.5)
+        stream_samples(samples, quality, 1.5)
+        # Play the target audio
+        with trial_profile.timed('sound load'):
+            target_stim = sound.Sound(record.target_path)
+        # Send EDF message
+        io.sendMessageEvent(text=TARGET_START, category=trial_num)
+        tracker.sendMessage('Target_Start')
+        target_stim.play()
+        stream_samples(samples, quality, target_stim.getDuration())
+        stream_samples(samples, quality, 2.7)
+        # Get pupil and other info
+        tracker.getLastSample()
+        io.sendMessageEvent(text=TRIAL_END, category=trial_num)
+        # Send EDF message
+        tracker.sendMessage('Trial_End')
+        stream_samples(samples, quality, 0)
+        if not CONTINUOUS_RECORDING and not RECORD_QUESTIONS:
+            tracker.setRecordingState(False)
+        # Store the data quality next to the response
+        record.update(quality.as_dict())
+        block_quality.append(quality.as_dict())
         win.flip()
         core.wait(1)
-        while True:
-            continue_message.draw()
-            win.flip()
-            contKey = event.waitKeys(keyList=["return"])
-            if 'return' in contKey:
-                # Continue to main trials
-                break
-    tracker.setRecordingState(True)
-    win.flip()
-    clock.reset()
-    trial_clock.reset()
-    io.sendMessageEvent(text=TRIAL_START, category=trial_num)
-    # Send EDF message
-    tracker.sendMessage('Trial_Start')
-    # Get the latest gaze position
-    gpos = tracker.getLastGazePosition()
-    tracker.getLastSample()
-    # Set up stim
-    current_prime = os.path.join(prime_folder, Prime)
-    prime_stim = sound.Sound(current_prime)
-    prime_stim.play()
-    core.wait(prime_stim.getDuration())
-    trial_clock.reset()
-    win.flip()
-    # Draw the fixation
-    io.sendMessageEvent(text=FIXATION_START, category=trial_num)
-    # Send EDF message
-    io.sendMessageEvent(text=FIXATION_START, category=trial_num)
-    tracker.sendMessage('Fixation_Start')
-    fixation_cross.draw()
-    win.flip()
-    core.wait(1.5)
-    # Play the target audio
-    current_target = os.path.join(target_folder, Target)
-    target_stim = sound.Sound(current_target)
-    # Send EDF message
-    io.sendMessageEvent(text=TARGET_START, category=trial_num)
-    tracker.sendMessage('Target_Start')
-    target_stim.play()
-    core.wait(target_stim.getDuration())
-    core.wait(2.7)
-    # Get pupil and other info
-    tracker.getLastSample()
-    io.sendMessageEvent(text=TRIAL_END, category=trial_num)
-    # Send EDF message
-    tracker.sendMessage('Trial_End')
-    tracker.setRecordingState(False)
-    win.flip()
-    core.wait(1)
-    # Set up question
-    current_question = Question
-    # Create 1/3 chance of question
-    # This checks whether the random number is 2 (show question)
-    question_num = random.randint(1,3)
-    if question_num == 2:
-        question_stim = TextStim(win, color=(0.8,1.0,0.5), font='SimSun', units='norm', text=Question, alignText='center')
-        question_stim.draw()
-        true_false_num = random.randint(1,2)
-        if true_false_num == 1:
-            true_false_stim1.draw()
-            win.flip()
-            # Check which key was pressed and record response
-            keys = event.waitKeys(keyList=["left", "right", "q"])
-            if "left" in keys:
-                trial_list.loc[index, "Response"] = "FALSE"
-            elif "right" in keys:
-                trial_list.loc[index, "Response"] = "TRUE"
-            elif "q" in keys:
-                core.quit()
+        # Set up question
+        if RECORD_QUESTIONS:
+            run_question(io, win, stims, record, tracker, samples)
+            if not CONTINUOUS_RECORDING:
+                tracker.setRecordingState(False)
         else:
-            true_false_stim2.draw()
-            win.flip()
-            keys = event.waitKeys(keyList=["left", "right", "q"])
-            if "left" in keys:
-                trial_list.loc[index, "Response"] = "TRUE"
-            elif "right" in keys:
-                trial_list.loc[index, "Response"] = "FALSE"
-            elif "q" in keys:
-                core.quit()
-    win.flip()
-    core.wait(1)
-    
-### MAIN EXPERIMENT ROUTINE END ###
-
-# Save trial_list to csv
-trial_list.to_csv('../results/subgroup'+subgroup+'_version'+version+'/'+\
-session_info+'_results.csv', encoding='utf_8_sig')
+            run_question(io, win, stims, record)
+        if status is not None:
+            status.update(record)
 
-# Save hdf5 file
-if __name__ == '__main__':
-    result = saveEventReport(hdf5FilePath=IOHUB_DATA_FILE,
-                             eventType=SAVE_EVENT_TYPE,
-                             eventFields=SAVE_EVENT_FIELDS,
-                             trialStart=TRIAL_START,
-                             trialStop=TRIAL_END)
-    if result:
-        file_saved, events_saved = result
-        print("Saved %d events to %s." % (events_saved, file_saved))
-    else:
-        raise RuntimeError("saveEventReport failed.")
+    if recording:
+        tracker.setRecordingState(False)
 
-### THANK YOU ROUTINE ###
+### MAIN EXPERIMENT ROUTINE END ###
 
-while True:
-    thankYou_txt_stim.draw()
+# Save the behavioural results of one session
+def save_results(trial_list, subgroup, version, session_info):
+    # Save trial_list to csv
+    trial_list.to_frame().to_csv('../results/subgroup'+subgroup+'_version'+version+'/'+\
+    session_info+'_results.csv', encoding='utf_8_sig')
+
+# Run one participant from calibration to the thank you screen
+def run_session(win, stims, exp_info):
+    # Make subgroup and version strings for concatenation and saving
+    part = str(exp_info['participant'])
+    subgroup = str(exp_info['subgroup'])
+    version = str(exp_info['version'])
+    rotation = str(exp_info['rotation'])
+    session_info = (f"{part}_sub{subgroup}_ver{version}_{rotation}")
+    tracker_info = str(exp_info['tracker (mouse/eyelink)'])
+
+    # The tracker was checked by session_dialog
+    devices_config = eyetracker_devices(tracker_info)
+    io, tracker = start_tracker(win, devices_config, session_info)
+
+    # Initialize a (global) clock
+    clock = Clock()
+    # Initialize a (trial) clock
+    trial_clock = Clock()
+
+    trial_list = TrialStore(make_trial_list(subgroup, version, rotation), prime_folder, target_folder)
+    practice_trials = TrialStore(make_practice_trials(rotation), prime_folder, target_folder)
+
+    # Welcome window; the text cache is filled while it is shown
+    stims['welcome'].draw()
     win.flip()
-    keys = kb.getKeys()
-    contKey = event.waitKeys()
-    if 'return' in contKey:
-        # End experiment
-        win.close()
-        tracker.setConnectionState(False)
-        core.quit()
+    shown = core.getTime()
+    stims.prepare([record.Question for store in (practice_trials, trial_list) for record in store])
+    wait(max(0.0, 3 - (core.getTime() - shown)))
 
-### END THANK YOU ROUTINE ###
+    ### INSTRUCTIONS ROUTINE ###
 
+    if rotation == 'm':
+        instruct_txt_stim = stims['instruct_m']
+    else:
+        instruct_txt_stim = stims['instruct_f']
+    wait_for_keys(io, win, ['return'], [instruct_txt_stim])
+
+    ### INSTRUCTIONS ROUTINE END ###
+
+    # Per phase timers for the trial loops
+    global trial_profile
+    trial_profile = PhaseTimes(enabled=PROFILE_TRIALS)
+    restore = [trial_profile.instrument(io, 'sendMessageEvent', 'io.sendMessageEvent'),
+               trial_profile.instrument(io, 'clearEvents', 'io.clearEvents'),
+               trial_profile.instrument(tracker, 'sendMessage', 'tracker.sendMessage'),
+               trial_profile.instrument(tracker, 'setRecordingState', 'setRecordingState'),
+               trial_profile.instrument(win, 'flip', 'win.flip')]
+    if PROFILE_TRIALS and PROFILE_SAMPLER:
+        trial_profile.start_sampler()
+
+    run_practice(io, tracker, win, stims, practice_trials, clock, trial_clock)
+    status = SessionStatus(session_info, len(trial_list)) if STATUS_FILE else None
+    run_trials(io, tracker, win, stims, trial_list, rotation, clock, trial_clock, status)
+    if status is not None:
+        status.finish()
+
+    for undo in restore:
+        undo()
+    if PROFILE_TRIALS:
+        trial_profile.stop_sampler(session_info+'_profile.html')
+        trial_profile.print_phase_summary()
+        trial_profile.write_csv(session_info+'_profile.csv')
+
+    save_results(trial_list, subgroup, version, session_info)
+
+    ### THANK YOU ROUTINE ###
+
+    wait_for_keys(io, win, ['return'], [stims['thank_you']])
+
+    ### END THANK YOU ROUTINE ###
+
+    # Closing the iohub server flushes and closes the .hdf5 datastore. The eye
+    # data export then runs in its own process (see session_export.py).
+    tracker.setConnectionState(False)
+    io.quit()
+    start_export(session_info+'.hdf5')
+
+def main():
+    global startup
+    startup.mark('dialog shown')
+    exp_info = session_dialog()
+    if exp_info is None:
+        quit()
+    startup.mark('dialog done')
+
+    with startup.timed('import backends'):
+        load_backends()
+
+    with startup.timed('open window'):
+        win = visual.Window((1280, 1024),
+                            units='pix',
+                            fullscr=True,
+                            allowGUI=False,
+                            colorSpace='rgb255',
+                            monitor='sls_Dell',
+                            color=BACKGROUND_COLOR,
+                            screen=0
+                            )
+    # Initialize a mouse set to invisible
+    mouse = Mouse(visible=False)
+    stims = LazyStims(win)
+
+    # Only Cancel in the dialogue box finishes the day
+    while exp_info is not None:
+        run_session(win, stims, exp_info)
+        if not SESSION_RUNNER:
+            break
+        # Keep the window for the next session
+        win.flip()
+        hideWindow(win)
+        # The next profile only covers the per session set-up (iohub and calibration)
+        startup = PhaseTimes()
+        exp_info = session_dialog()
+        showWindow(win)
+
+    # End experiment
+    win.close()
+    core.quit()
+
+if __name__ == '__main__':
+    main()
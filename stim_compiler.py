@@ -0,0 +1,223 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Compile the trial list masters (stim_lists/subgroup<S>_version<V>_stims.xlsx)
+# into the per subgroup/version/rotation csvs the experiment script reads
+# (stim_lists/subgroup<S>version<V>_<f|m>.csv), plus an optional compact
+# binary plan (.plan.npz) of the same rows.
+#
+# Outputs are only rebuilt when their master changed since the last run (or
+# the output was edited or deleted); the hashes are kept in
+# stim_lists/.compiled.json. For each rebuilt output the column and row
+# differences to the csv on disk are reported.
+#
+# Usage: python stim_compiler.py [--check] [--force] [--plan] [--lint]
+#   --check  only report what would change; exit status 1 if anything would
+#   --lint   list column name variants and file names differing only in case
+#            over all trial list csvs (stim_lists/ and archive/)
+#
+# Hand made lists (practice_*.csv, the short *_test.csv lists) are left alone.
+
+STIM_DIR = 'stim_lists'
+MANIFEST = os.path.join(STIM_DIR, '.compiled.json')
+MASTER_PATTERN = re.compile(r'subgroup(\d+)_version(\d+)_stims\.xlsx$')
+
+# Column order of the compiled csvs (as in the current lists)
+COLUMNS = ['Section', 'ID', 'Prime', 'Target', 'Target_Word', 'CorrectA', 'Code', 'Dur',
+           'Question', 'SentenceID', 'SpeakerGender', 'SpeakerID', 'SentenceGroup',
+           'PitchLevel', 'ContentCongruency', 'PitchTypicality']
+
+# Known misspellings of column names in the masters and older lists
+RENAMES = {'CorrrectA': 'CorrectA'}
+
+# Output rotation by speaker gender
+ROTATIONS = {'F': 'f', 'M': 'm'}
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest():
+    if os.path.exists(MANIFEST):
+        with open(MANIFEST, encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(manifest):
+    with open(MANIFEST + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(MANIFEST + '.tmp', MANIFEST)
+
+
+# Master sheet -> trial list rows. In the masters `Target` is the target word
+# and the target audio is named after the prime with `_tar` before the pitch.
+def compile_master(master_path):
+    master = pd.read_excel(master_path).rename(columns=RENAMES)
+    master = master.rename(columns={'Target': 'Target_Word'})
+    master['Target'] = master['Prime'].str.replace(r'_([^_]+\.wav)$', r'_tar_\1', regex=True)
+    outputs = dict()
+    for gender, rows in master.groupby('SpeakerGender', sort=False):
+        rotation = ROTATIONS[gender]
+        outputs[rotation] = rows[COLUMNS].reset_index(drop=True)
+    return outputs
+
+
+def read_list(path):
+    return pd.read_csv(path, encoding='utf-8-sig')
+
+
+# Write a list as the current csvs are saved: BOM and TRUE/FALSE
+def write_list(path, rows):
+    rows = rows.copy()
+    for column in rows.columns:
+        if pd.api.types.is_bool_dtype(rows[column]):
+            rows[column] = rows[column].map({True: 'TRUE', False: 'FALSE'})
+    rows.to_csv(path, index=False, encoding='utf_8_sig')
+
+
+# Column and row differences between the csv on disk and the new rows
+def diff_lists(old, new):
+    lines = []
+    renamed = [c for c in old.columns if c in RENAMES and RENAMES[c] in new.columns]
+    for column in renamed:
+        lines.append(f"  column renamed: {column} -> {RENAMES[column]}")
+    old = old.rename(columns=RENAMES)
+    for column in new.columns.difference(old.columns):
+        lines.append(f"  column added: {column}")
+    for column in old.columns.difference(new.columns):
+        lines.append(f"  column removed: {column}")
+    if list(old.columns) != list(new.columns) and set(old.columns) == set(new.columns):
+        lines.append("  column order changed")
+    old_ids, new_ids = set(old['ID']), set(new['ID'])
+    if new_ids - old_ids:
+        lines.append(f"  rows added: ID {sorted(new_ids - old_ids)}")
+    if old_ids - new_ids:
+        lines.append(f"  rows removed: ID {sorted(old_ids - new_ids)}")
+    shared = [c for c in new.columns if c in old.columns and c != 'ID']
+    ids = sorted(old_ids & new_ids)
+    if ids:
+        a = old.set_index('ID').loc[ids, shared].astype(str)
+        b = new.set_index('ID').loc[ids, shared].astype(str)
+        changed = (a != b).sum()
+        for column, count in changed[changed > 0].items():
+            lines.append(f"  {column}: {count} rows changed")
+        if [i for i in old['ID'] if i in new_ids] != [i for i in new['ID'] if i in old_ids]:
+            lines.append("  row order changed")
+    return lines
+
+
+# Compact binary copy of a trial list: numbers as small ints/floats and text
+# columns as category codes with their labels
+def write_plan(path, rows):
+    arrays = dict()
+    for column in rows.columns:
+        values = rows[column]
+        if pd.api.types.is_bool_dtype(values):
+            arrays[column] = values.to_numpy(bool)
+        elif pd.api.types.is_integer_dtype(values):
+            arrays[column] = values.to_numpy('i4')
+        elif pd.api.types.is_float_dtype(values):
+            arrays[column] = values.to_numpy('f4')
+        else:
+            codes, labels = pd.factorize(values.astype(str))
+            arrays[column] = codes.astype('i2')
+            arrays[column + '__labels'] = np.asarray(labels, dtype=str)
+    np.savez_compressed(path, **arrays)
+
+
+def compile_all(check=False, force=False, plan=False):
+    manifest = load_manifest()
+    outdated = False
+    for master_path in sorted(glob.glob(os.path.join(STIM_DIR, '*_stims.xlsx'))):
+        match = MASTER_PATTERN.search(os.path.basename(master_path))
+        if not match:
+            continue
+        subgroup, version = match.groups()
+        master_hash = file_hash(master_path)
+        entry = manifest.get(master_path, {})
+        up_to_date = (not force and entry.get('hash') == master_hash
+                      and all(os.path.exists(p) and file_hash(p) == h
+                              for p, h in entry.get('output_hashes', {}).items()))
+        if up_to_date:
+            print(f"{master_path}: up to date")
+            continue
+
+        compiled = compile_master(master_path)
+        outputs = {os.path.join(STIM_DIR, f"subgroup{subgroup}version{version}_{rotation}.csv"): rows
+                   for rotation, rows in compiled.items()}
+        output_hashes = dict()
+        for path, rows in outputs.items():
+            if os.path.exists(path):
+                lines = diff_lists(read_list(path), rows)
+            else:
+                lines = ["  new file"]
+            print(f"{path} (from {master_path}):")
+            print("\n".join(lines) if lines else "  no changes")
+            outdated = outdated or bool(lines)
+            if check:
+                continue
+            # Unchanged lists are kept byte for byte (Excel's number formatting)
+            if lines:
+                write_list(path, rows)
+            output_hashes[path] = file_hash(path)
+            if plan:
+                write_plan(path[:-len('.csv')] + '.plan.npz', rows)
+        if not check:
+            manifest[master_path] = {'hash': master_hash, 'output_hashes': output_hashes}
+    if not check:
+        save_manifest(manifest)
+    return outdated
+
+
+# Column name variants and case clashes of file names over all list csvs
+def lint(paths):
+    columns = dict()
+    for path in paths:
+        for column in read_list(path).columns:
+            columns.setdefault(column.lower(), {}).setdefault(column, []).append(path)
+    for variants in columns.values():
+        if len(variants) > 1:
+            print("Column name variants: " + ", ".join(f"{name} ({len(files)} files)"
+                                                      for name, files in variants.items()))
+    for wrong, right in RENAMES.items():
+        files = columns.get(wrong.lower(), {}).get(wrong, [])
+        if files:
+            print(f"Misspelt column {wrong} (should be {right}) in: " + ", ".join(files))
+    names = dict()
+    for path in paths:
+        names.setdefault(os.path.basename(path).lower(), []).append(path)
+    for clash in names.values():
+        if len(set(os.path.basename(p) for p in clash)) > 1:
+            print("File names differing only in case: " + ", ".join(clash))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile the trial list masters into csvs.')
+    parser.add_argument('--check', action='store_true', help='only report differences')
+    parser.add_argument('--force', action='store_true', help='rebuild all outputs')
+    parser.add_argument('--plan', action='store_true', help='also write .plan.npz files')
+    parser.add_argument('--lint', action='store_true', help='report column and file name drift')
+    args = parser.parse_args()
+    if args.lint:
+        lint(sorted(glob.glob(os.path.join(STIM_DIR, '*.csv')) + glob.glob('archive/*.csv')))
+        return 0
+    outdated = compile_all(check=args.check, force=args.force, plan=args.plan)
+    return 1 if args.check and outdated else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,272 @@
+import argparse
+import os
+import wave
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import tables
+
+import gaze_data
+
+# Synthetic eye tracking sessions for load and scale testing of the analysis
+# scripts. Each session follows a real trial list from stim_lists/ with the
+# timing of sexuality_stereotypes_v2.py (prime sentence of the list's `Dur`,
+# 1.5 s fixation cross, target word + 2.7 s, 1 s ITI, question on 1/3 of the
+# trials) and writes
+#   <session>.hdf5          iohub style MonocularEyeSampleEvent and MessageEvent
+#                           tables at 1000 Hz, recorded from trial start to end
+#   <session>_results.csv   the trial list as the experiment script saves it
+#   targets/<Target>        a silent wav of each target word, 0.3-0.7 s long
+#                           (for timing_audit.py --targets)
+#
+# The gaze has fixations, saccades and blinks; the pupil has a slow drift and
+# a response to the target that is larger on incongruent trials.
+#
+# Usage: python synthetic_sessions.py <out_dir> --participants 200 --jobs 4
+#
+# Only the tables read by gaze_data.py are written, not the iohub session and
+# experiment meta data tables.
+
+RATE = 1000
+SCREEN_SIZE = (1280, 1024)
+FIXATION_DURATION = 1.5
+TARGET_EXTRA = 2.7
+ITI = 1.0
+
+# Subset of the iohub MonocularEyeSampleEvent columns
+SAMPLE_DTYPE = np.dtype([('experiment_id', 'u4'), ('session_id', 'u4'), ('device_id', 'u2'),
+                         ('event_id', 'u4'), ('type', 'u1'), ('device_time', 'f8'),
+                         ('logged_time', 'f8'), ('time', 'f8'), ('confidence_interval', 'f4'),
+                         ('delay', 'f4'), ('filter_id', 'i2'), ('eye', 'u1'),
+                         ('gaze_x', 'f4'), ('gaze_y', 'f4'), ('pupil_measure1', 'f4'),
+                         ('pupil_measure1_type', 'u1'), ('status', 'u1')])
+
+MESSAGE_DTYPE = np.dtype([('experiment_id', 'u4'), ('session_id', 'u4'), ('device_id', 'u2'),
+                          ('event_id', 'u4'), ('type', 'u1'), ('device_time', 'f8'),
+                          ('logged_time', 'f8'), ('time', 'f8'), ('confidence_interval', 'f4'),
+                          ('delay', 'f4'), ('filter_id', 'i2'), ('msg_offset', 'f4'),
+                          ('category', 'S32'), ('text', 'S128')])
+
+# iohub event type ids
+MONOCULAR_EYE_SAMPLE = 51
+MESSAGE = 151
+
+# Subgroup, version and rotation of each generated participant, in turn
+LISTS = [(s, v, r) for r in ('f', 'm') for s in (1, 2) for v in (1, 2)]
+
+# Duration range (sec) and sample rate of the synthetic target word clips
+TARGET_DURATION = (0.3, 0.7)
+AUDIO_RATE = 8000
+
+
+# Duration (sec) of the clip of a target word, the same in every session (from
+# a hash of the file name) and a whole number of audio frames
+def target_duration(target):
+    fraction = zlib.crc32(target.encode('utf-8')) / 2 ** 32
+    duration = TARGET_DURATION[0] + fraction * (TARGET_DURATION[1] - TARGET_DURATION[0])
+    return round(duration * AUDIO_RATE) / AUDIO_RATE
+
+
+# Write a silent wav of each target not written yet
+def write_targets(target_dir, targets):
+    os.makedirs(target_dir, exist_ok=True)
+    for target in targets:
+        path = os.path.join(target_dir, target)
+        if os.path.exists(path):
+            continue
+        # Other processes may write the same target
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with wave.open(tmp, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(AUDIO_RATE)
+            f.writeframes(bytes(2 * round(target_duration(target) * AUDIO_RATE)))
+        os.replace(tmp, path)
+
+
+# Trial list as sexuality_stereotypes_v2.make_trial_list makes it
+def make_trial_list(rng, subgroup, version, rotation, stim_dir='stim_lists'):
+    trial_list = pd.read_csv(os.path.join(stim_dir, f'subgroup{subgroup}version{version}_{rotation}.csv'))
+    trial_list = trial_list.iloc[rng.permutation(len(trial_list))]
+    order = rng.permutation([1, 2, 3, 4])
+    trial_list['Section'] = pd.Categorical(trial_list['Section'], categories=order, ordered=True)
+    return trial_list.sort_values(by='Section', kind='stable').reset_index()
+
+
+# Gaze of one recording of `n` samples: fixations near `centre` joined by
+# 30 ms saccades, plus noise
+def synthetic_gaze(rng, n, centre=(0.0, 0.0), spread=80.0):
+    durations = np.maximum(rng.gamma(4.0, 60.0, size=n // 100 + 2).astype(int), 60)
+    starts = np.concatenate(([0], np.cumsum(durations)))
+    starts = starts[starts < n]
+    positions = rng.normal(centre, spread, size=(len(starts), 2))
+    fixation = np.searchsorted(starts, np.arange(n), side='right') - 1
+    into = np.arange(n) - starts[fixation]
+    previous = positions[np.maximum(fixation - 1, 0)]
+    ramp = np.clip(into / 30.0, 0.0, 1.0)[:, None]
+    gaze = previous + (positions[fixation] - previous) * ramp
+    return gaze + rng.normal(0.0, 0.5, size=gaze.shape)
+
+
+# Blink mask of `n` samples (about one blink every 3 s, 80-200 ms long)
+def synthetic_blinks(rng, n):
+    blinks = np.zeros(n, dtype=bool)
+    for onset in np.flatnonzero(rng.random(n) < 1.0 / (3 * RATE)):
+        blinks[onset:onset + rng.integers(80, 200)] = True
+    return blinks
+
+
+# Pupil area: baseline with a slow drift and a response peaking ~1 s after the
+# target onset (sample `target`)
+def synthetic_pupil(rng, n, target, amplitude):
+    t = np.arange(n) / RATE
+    pupil = rng.normal(1000.0, 50.0) + 5.0 * np.sin(2 * np.pi * t / rng.uniform(8, 15))
+    after = np.clip(t - target / RATE, 0.0, None)
+    pupil += amplitude * (after / 0.93) ** 10.1 * np.exp(-10.1 * (after / 0.93 - 1.0)) * (after > 0)
+    return pupil + rng.normal(0.0, 2.0, size=n)
+
+
+# Samples and messages of all trials of a session, and the question onset
+# and key press time of each main trial (NaN if no question was shown)
+def synthetic_session(seed, trial_list, practice):
+    rng = np.random.default_rng(seed)
+    samples, messages = [], []
+    questions = []
+    now = 10.0
+
+    def message(text, category):
+        messages.append((now, text, category))
+
+    def record(prime_dur, target_dur, amplitude, texts, category):
+        nonlocal now
+        start = now
+        message(texts[0], category)
+        now += prime_dur
+        message(texts[1], category)
+        if texts[1] == gaze_data.FIXATION_START and texts[0] == gaze_data.TRIAL_START:
+            # The experiment script sends FIXATION_START twice in the main trials
+            message(texts[1], category)
+        fixation = now
+        now += FIXATION_DURATION
+        message(texts[2], category)
+        target = now
+        now += target_dur + TARGET_EXTRA
+        message(texts[3], category)
+        n = int((now - start) * RATE)
+        gaze = synthetic_gaze(rng, n)
+        # Look at the fixation cross while it is shown
+        on_cross = slice(int((fixation - start) * RATE), int((target - start) * RATE))
+        gaze[on_cross] = rng.normal(rng.normal(0.0, 15.0, size=2), 3.0, size=gaze[on_cross].shape)
+        blinks = synthetic_blinks(rng, n)
+        pupil = synthetic_pupil(rng, n, int((target - start) * RATE), amplitude)
+        chunk = np.zeros(n, dtype=SAMPLE_DTYPE)
+        chunk['time'] = start + np.arange(n) / RATE
+        chunk['gaze_x'] = np.where(blinks, np.nan, gaze[:, 0])
+        chunk['gaze_y'] = np.where(blinks, np.nan, gaze[:, 1])
+        chunk['pupil_measure1'] = np.where(blinks, 0.0, pupil)
+        chunk['status'] = np.where(blinks, 2, 0)
+        samples.append(chunk)
+        # ITI, the question on 1/3 of the trials and the blank after it
+        now += ITI
+        onset = press = np.nan
+        if rng.random() < 1 / 3:
+            onset = now
+            now += rng.lognormal(0.2, 0.4)
+            press = now
+        now += 1.0
+        return onset, press
+
+    practice_texts = (gaze_data.PRACTICE_START, gaze_data.FIXATION_START,
+                      gaze_data.PRACTICETARG_START, gaze_data.PRACTICE_END)
+    # The prime is the sentence of the list's `Dur` (sec in the practice lists,
+    # msec in the trial lists); the target is the critical word
+    for index, row in practice.iterrows():
+        record(row['Dur'], target_duration(row['Target']), 100.0, practice_texts, str(index))
+    trial_texts = (gaze_data.TRIAL_START, gaze_data.FIXATION_START,
+                   gaze_data.TARGET_START, gaze_data.TRIAL_END)
+    for index, row in trial_list.iterrows():
+        amplitude = 150.0 if row['ContentCongruency'] == 'incongruent' else 100.0
+        questions.append(record(row['Dur'] / 1000.0, target_duration(row['Target']), amplitude,
+                                trial_texts, str(index)))
+
+    samples = np.concatenate(samples)
+    samples['type'] = MONOCULAR_EYE_SAMPLE
+    samples['event_id'] = np.arange(len(samples))
+    samples['device_time'] = samples['logged_time'] = samples['time']
+    samples['pupil_measure1_type'] = 70
+    events = np.zeros(len(messages), dtype=MESSAGE_DTYPE)
+    events['type'] = MESSAGE
+    events['event_id'] = len(samples) + np.arange(len(messages))
+    events['time'] = events['device_time'] = events['logged_time'] = [m[0] for m in messages]
+    events['text'] = [m[1].encode('utf-8') for m in messages]
+    events['category'] = [m[2].encode('utf-8') for m in messages]
+    return samples, events, np.array(questions, dtype='f8').reshape(-1, 2)
+
+
+def write_hdf5(path, samples, events):
+    with tables.open_file(path, mode='w') as h5:
+        filters = tables.Filters(complevel=1, complib='blosc')
+        for table, data in ((gaze_data.SAMPLE_TABLE, samples), (gaze_data.MESSAGE_TABLE, events)):
+            where, name = table.rsplit('/', 1)
+            h5.create_table(where, name, obj=data, createparents=True, filters=filters)
+
+
+# Generate participant `participant` into `out_dir`; returns the file names
+def generate_participant(participant, out_dir, seed=0, stim_dir='stim_lists'):
+    rng = np.random.default_rng([seed, participant])
+    subgroup, version, rotation = LISTS[participant % len(LISTS)]
+    trial_list = make_trial_list(rng, subgroup, version, rotation, stim_dir)
+    practice = pd.read_csv(os.path.join(stim_dir, 'practice_female.csv' if rotation == 'f'
+                                        else 'practice_male.csv'))
+    practice = practice.iloc[rng.permutation(len(practice))].reset_index()
+    samples, events, questions = synthetic_session(rng.integers(2 ** 32), trial_list, practice)
+    write_targets(os.path.join(out_dir, 'targets'),
+                  sorted(set(trial_list['Target']) | set(practice['Target'])))
+
+    # Behavioural results as the experiment script saves them, with the
+    # question timing used for the message stream
+    trial_list['Trial'] = np.arange(1, len(trial_list) + 1)
+    shown = ~np.isnan(questions[:, 0])
+    trial_list['Response'] = np.where(shown, np.where(rng.random(len(trial_list)) < 0.5, 'TRUE', 'FALSE'), None)
+    trial_list['QuestionOnset'] = questions[:, 0]
+    trial_list['ResponseTime'] = questions[:, 1]
+    trial_list['RT'] = questions[:, 1] - questions[:, 0]
+
+    session_info = f"{participant}_sub{subgroup}_ver{version}_{rotation}"
+    hdf5_path = os.path.join(out_dir, session_info + '.hdf5')
+    results_path = os.path.join(out_dir, session_info + '_results.csv')
+    write_hdf5(hdf5_path, samples, events)
+    trial_list.to_csv(results_path, encoding='utf_8_sig')
+    return hdf5_path, results_path
+
+
+def _generate(args):
+    return generate_participant(*args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic eye tracking sessions.')
+    parser.add_argument('out_dir')
+    parser.add_argument('--participants', type=int, default=10)
+    parser.add_argument('--first', type=int, default=1, help='first participant number')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', type=int, default=1, help='number of processes')
+    parser.add_argument('--stim-dir', default='stim_lists')
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    work = [(p, args.out_dir, args.seed, args.stim_dir)
+            for p in range(args.first, args.first + args.participants)]
+    if args.jobs > 1:
+        with Pool(args.jobs) as pool:
+            for hdf5_path, _ in pool.imap_unordered(_generate, work):
+                print(hdf5_path)
+    else:
+        for item in work:
+            print(_generate(item)[0])
+
+
+if __name__ == '__main__':
+    main()
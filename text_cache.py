@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import psychopy
+from PIL import Image
+from psychopy import visual
+
+# On disk cache of rendered text. Rasterising the SimSun (CJK) texts is the
+# slow part of making a TextStim, so before the instructions the experiment
+# script fills the cache with every text of the session (fill()): each text not
+# cached yet is rendered, captured from the back buffer and saved as a PNG
+# (plus a small json with its position and size). During the trials stim()
+# only loads the PNG as an ImageStim and never writes; a text missing from the
+# cache is shown as a live TextStim. Entries are keyed by the TextStim
+# settings, the window size and background colour, the PsychoPy version and
+# the version of the entry format.
+#
+# The capture keeps the window background colour around the glyphs, so the
+# cached images are made transparent wherever the pixels equal the background.
+
+# Blank pixels kept around the text's bounding box
+MARGIN = 4
+
+# Version of the saved entries; older entries are not used
+FORMAT = 2
+
+
+class TextCache:
+    def __init__(self, cache_dir, win):
+        self.cache_dir = cache_dir
+        self.win = win
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, params):
+        # The background colour is in the key as the transparency is cut against it
+        settings = json.dumps([sorted((k, repr(v)) for k, v in params.items()),
+                               [int(v) for v in self.win.size],
+                               [float(v) for v in np.ravel(self.win.color)], self.win.colorSpace,
+                               psychopy.__version__, FORMAT],
+                              ensure_ascii=False)
+        return hashlib.sha1(settings.encode('utf-8')).hexdigest()
+
+    # Text stim with the given TextStim settings: an ImageStim of the cached
+    # rendering if there is one, otherwise a live TextStim
+    def stim(self, **params):
+        base = os.path.join(self.cache_dir, self._key(params))
+        if os.path.exists(base + '.json'):
+            try:
+                return self._load(base)
+            except (OSError, ValueError, KeyError):
+                pass
+        return visual.TextStim(self.win, **params)
+
+    # Render and save each of the texts (dicts of TextStim settings) that is
+    # not cached yet. Only draws on the back buffer, so the screen shown stays
+    # up. Returns the number of texts added.
+    def fill(self, texts):
+        added = 0
+        for params in texts:
+            base = os.path.join(self.cache_dir, self._key(params))
+            if os.path.exists(base + '.json'):
+                continue
+            try:
+                self._save(base, visual.TextStim(self.win, **params))
+                added += 1
+            except Exception as error:
+                print(f"Text not cached ({error!r}); it will be rendered live.")
+        return added
+
+    def _load(self, base):
+        with open(base + '.json', encoding='utf-8') as f:
+            meta = json.load(f)
+        stim = visual.ImageStim(self.win, image=base + '.png', units='pix', pos=meta['pos'],
+                                size=meta['size'], interpolate=False)
+        # Text, box of the text without the margin and letter height, for aoi.text_box
+        stim.text = meta['text']
+        stim.text_bounds = (meta['pos'], meta['box'], meta['height'])
+        return stim
+
+    # Draw the stim on the (cleared) back buffer and save the region it covers
+    def _save(self, base, stim):
+        box = [float(v) for v in stim.boundingBox]
+        cx, cy = stim.posPix
+        width, height = box[0] + 2 * MARGIN, box[1] + 2 * MARGIN
+        self.win.clearBuffer()
+        stim.draw()
+        frame = self.win.getMovieFrame(buffer='back')
+        self.win.movieFrames.pop()
+        self.win.clearBuffer()
+        left = int(round(frame.size[0] / 2 + cx - width / 2))
+        top = int(round(frame.size[1] / 2 - cy - height / 2))
+        pixels = np.asarray(frame.convert('RGB').crop((left, top, left + int(width), top + int(height))))
+        # The margin is background only
+        alpha = np.any(pixels != pixels[0, 0], axis=2).astype('u1') * 255
+        Image.fromarray(np.dstack([pixels, alpha]), 'RGBA').save(base + '.png.tmp', format='PNG')
+        os.replace(base + '.png.tmp', base + '.png')
+        meta = {'text': stim.text, 'pos': [float(cx), float(cy)],
+                'size': [int(width), int(height)], 'box': box,
+                'height': float(stim._heightPix)}
+        # The json is written last, so an entry is only used once complete
+        with open(base + '.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(base + '.json.tmp', base + '.json')
@@ -0,0 +1,249 @@
+import argparse
+import glob
+import os
+import wave
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+import gaze_data
+
+# Timing audit of recorded sessions. The trial sequence of a session is
+# rebuilt from its results csv (trials in the order they were run, `index` =
+# row of the stim list) and the phases of sexuality_stereotypes_v2.run_trials
+# are replayed on a virtual clock from each recorded trial start, with the
+# prime duration from the design (`Dur`, the sentence) and the target duration
+# from the header of its wav (the critical word). The expected message times
+# are compared with the recorded ones:
+#
+#   prime     trial_start -> fixation_start     prime `Dur`
+#   fixation  fixation_start -> target_start    1.5 s
+#   target    target_start -> trial_end         target wav duration + 2.7 s
+#   question  trial_end -> QuestionOnset        1 s (question shown)
+#   response  ResponseTime -> next trial_start  1 s (question shown)
+#   iti       trial_end -> next trial_start     2 s (no question)
+#
+# QuestionOnset and ResponseTime are saved in the results on the iohub clock
+# of the messages. The phase ending at the next trial start is longer before
+# a break, so there it is only checked for being too short; so is the ITI of
+# older results with a Response but no question timing.
+#
+# Each phase also includes steps of the script that are not in the design
+# (PHASE_STEPS: flips, sound loading, recording on/off, ...). A phase is only
+# late if it is longer than the tolerance plus an allowance for these steps:
+# their 95th percentile duration in the main trials of the session's
+# <session>_profile.csv (PROFILE_TRIALS) if there is one next to the .hdf5,
+# otherwise the upper estimates of STEP_ALLOWANCE.
+#
+# Nothing is drawn or played, so a session is audited in well under a second.
+#
+# Usage: python timing_audit.py <session>.hdf5 [...] [--results ../results]
+#            [--targets ../targets] [--tolerance 0.05] [--jobs 4]
+#
+# Writes <session>_timing.csv next to each .hdf5 and prints the number of
+# trials outside the tolerance per phase.
+
+FIXATION_DURATION = 1.5
+TARGET_EXTRA = 2.7
+ITI = 1.0
+# Blank screen after the question (or after the ITI if no question was shown)
+QUESTION_WAIT = 1.0
+
+# Trial numbers preceded by a break
+BREAK_TRIALS = {'f': (26, 51, 76), 'm': (26, 51, 76), 'test': (4, 7, 10)}
+
+PHASES = ('prime', 'fixation', 'target', 'question', 'response', 'iti')
+
+# Phases ending at the next trial start
+TO_NEXT_TRIAL = ('response', 'iti')
+
+# Steps run inside each phase besides the waits of the design, by their
+# profile names (see sexuality_stereotypes_v2.run_trials and run_question).
+# The key press ending the question is only seen after the next flip. With
+# RECORD_QUESTIONS the recording stops in the response phase instead of the
+# question phase.
+PHASE_STEPS = {'prime': ('tracker.sendMessage', 'sound load', 'win.flip'),
+               'fixation': ('io.sendMessageEvent', 'tracker.sendMessage', 'win.flip', 'sound load'),
+               'target': ('tracker.sendMessage',),
+               'question': ('tracker.sendMessage', 'setRecordingState', 'win.flip',
+                            'question stim', 'win.flip'),
+               'response': ('win.flip', 'win.flip', 'stim construction', 'io.clearEvents',
+                            'setRecordingState', 'win.flip'),
+               'iti': ('tracker.sendMessage', 'setRecordingState', 'win.flip', 'win.flip',
+                       'stim construction', 'io.clearEvents', 'setRecordingState', 'win.flip')}
+
+# Allowance (sec) per step without a profile: a frame at 60 Hz per flip and
+# upper estimates of the rest (EyeLink recording on/off is the slowest)
+STEP_ALLOWANCE = {'win.flip': 1 / 60,
+                  'sound load': 0.05,
+                  'setRecordingState': 0.15,
+                  'question stim': 0.03,
+                  'stim construction': 0.01,
+                  'io.clearEvents': 0.005,
+                  'io.sendMessageEvent': 0.005,
+                  'tracker.sendMessage': 0.005}
+
+
+# Duration (sec) of a wav file, NaN if it cannot be read
+def wav_duration(path):
+    try:
+        with wave.open(path, 'rb') as f:
+            return f.getnframes() / f.getframerate()
+    except (OSError, EOFError, wave.Error):
+        return np.nan
+
+
+# Allowance (sec) for the steps of each phase, from the trial profile of the
+# session (csv written by profiling.PhaseTimes) if given, else STEP_ALLOWANCE
+def phase_allowances(profile_path=None):
+    steps = dict(STEP_ALLOWANCE)
+    if profile_path is not None:
+        profile = pd.read_csv(profile_path, dtype={'trial': str})
+        trial = profile['trial'].fillna('')
+        main = profile[(trial != '') & ~trial.str.startswith('practice')]
+        steps.update(main.groupby('phase')['duration_s'].quantile(0.95).to_dict())
+    return {phase: sum(steps.get(step, 0.0) for step in PHASE_STEPS[phase]) for phase in PHASES}
+
+
+def _column(results, name):
+    if name in results:
+        return pd.to_numeric(results[name], errors='coerce').to_numpy('f8')
+    return np.full(len(results), np.nan)
+
+
+# Question onset and key press (iohub time) of each trial, NaN if no question
+# was shown, and whether a question was answered without its timing saved
+def question_times(results):
+    onset, press = _column(results, 'QuestionOnset'), _column(results, 'ResponseTime')
+    answered = results['Response'].notna().to_numpy() if 'Response' in results else np.zeros(len(results), bool)
+    untimed = answered & (np.isnan(onset) | np.isnan(press))
+    return onset, press, untimed
+
+
+# Expected duration of each phase of each trial of the results frame.
+# `target_durations` gives the target audio duration per trial (NaN if unknown).
+def expected_durations(results, target_durations, rotation='f'):
+    n = len(results)
+    onset, press, untimed = question_times(results)
+    shown = ~np.isnan(onset) & ~np.isnan(press)
+    expected = {'prime': _column(results, 'Dur') / 1000.0,
+                'fixation': np.full(n, FIXATION_DURATION),
+                'target': np.asarray(target_durations, dtype='f8') + TARGET_EXTRA,
+                'question': np.where(shown, ITI, np.nan),
+                'response': np.where(shown, QUESTION_WAIT, np.nan),
+                'iti': np.where(shown, np.nan, ITI + QUESTION_WAIT)}
+    # The last trial has no next start
+    for phase in TO_NEXT_TRIAL:
+        expected[phase][-1:] = np.nan
+    trial = np.arange(1, n + 1)
+    # Only too short is checked before a break or without the question timing
+    lower_bound_only = np.isin(trial + 1, BREAK_TRIALS.get(rotation, ())) | untimed
+    return expected, lower_bound_only
+
+
+# Recorded duration of each phase from the trial index and the question
+# timing of the results, one row per results row
+def recorded_durations(index, results):
+    n = len(results)
+    rows = np.full(n, -1)
+    inside = (index['trial'] >= 0) & (index['trial'] < n)
+    rows[index['trial'][inside]] = np.flatnonzero(inside)
+    found = rows >= 0
+
+    def times(field):
+        values = np.full(n, np.nan)
+        values[found] = index[field][rows[found]]
+        return values
+
+    start, fixation, target, end = (times(f) for f in ('start', 'fixation', 'target', 'end'))
+    next_start = np.append(start[1:], np.nan)
+    onset, press, _ = question_times(results)
+    shown = ~np.isnan(onset) & ~np.isnan(press)
+    return start, {'prime': fixation - start,
+                   'fixation': target - fixation,
+                   'target': end - target,
+                   'question': onset - end,
+                   'response': next_start - press,
+                   'iti': np.where(shown, np.nan, next_start - end)}
+
+
+# Audit one session. Returns a frame with one row per trial: the recorded and
+# expected duration of each phase, their difference, the allowance for the
+# script's own steps and whether it is outside the tolerance.
+def audit_session(hdf5_path, results_path, target_folder=None, tolerance=0.05, rotation='f',
+                  profile_path=None):
+    results = pd.read_csv(results_path, index_col=0, encoding='utf-8-sig')
+    index = gaze_data.trial_index(gaze_data.read_messages(hdf5_path))
+    if target_folder is not None:
+        target_durations = [wav_duration(os.path.join(target_folder, target)) for target in results['Target']]
+    else:
+        target_durations = np.full(len(results), np.nan)
+    expected, lower_bound_only = expected_durations(results, target_durations, rotation)
+    start, recorded = recorded_durations(index, results)
+    allowances = phase_allowances(profile_path)
+
+    audit = pd.DataFrame({'Trial': np.arange(1, len(results) + 1),
+                          'index': results['index'].to_numpy() if 'index' in results else results.index,
+                          'ID': results['ID'].to_numpy(),
+                          'start': start,
+                          'missing': np.isnan(start)})
+    for phase in PHASES:
+        diff = recorded[phase] - expected[phase]
+        late = diff > tolerance + allowances[phase]
+        if phase in TO_NEXT_TRIAL:
+            late &= ~lower_bound_only
+        audit[phase] = recorded[phase]
+        audit[phase + '_expected'] = expected[phase]
+        audit[phase + '_diff'] = diff
+        audit[phase + '_allowance'] = allowances[phase]
+        audit[phase + '_flag'] = late | (diff < -tolerance)
+    return audit
+
+
+# results csv of a session: <session>_results.csv anywhere under `results_dir`
+def find_results(hdf5_path, results_dir):
+    session = os.path.splitext(os.path.basename(hdf5_path))[0]
+    matches = glob.glob(os.path.join(results_dir, '**', session + '_results.csv'), recursive=True)
+    if not matches:
+        raise FileNotFoundError(f"No {session}_results.csv under {results_dir}")
+    return matches[0]
+
+
+def _audit(args):
+    hdf5_path, results_dir, target_folder, tolerance = args
+    results_dir = results_dir or os.path.dirname(hdf5_path)
+    base = os.path.splitext(hdf5_path)[0]
+    rotation = os.path.basename(base).rsplit('_', 1)[-1]
+    profile_path = base + '_profile.csv'
+    audit = audit_session(hdf5_path, find_results(hdf5_path, results_dir), target_folder,
+                          tolerance, rotation,
+                          profile_path if os.path.exists(profile_path) else None)
+    audit.to_csv(base + '_timing.csv', index=False)
+    counts = {phase: int(audit[phase + '_flag'].sum()) for phase in PHASES}
+    return hdf5_path, len(audit), int(audit['missing'].sum()), counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Audit the trial timing of recorded sessions.')
+    parser.add_argument('hdf5', nargs='+')
+    parser.add_argument('--results', help='directory searched for <session>_results.csv '
+                                          '(default: next to the .hdf5)')
+    parser.add_argument('--targets', help='target audio folder, to check the target durations')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='sec')
+    parser.add_argument('--jobs', type=int, default=1, help='number of processes')
+    args = parser.parse_args()
+
+    work = [(path, args.results, args.targets, args.tolerance) for path in args.hdf5]
+    if args.jobs > 1:
+        with Pool(args.jobs) as pool:
+            audits = list(pool.imap(_audit, work))
+    else:
+        audits = map(_audit, work)
+    for hdf5_path, n_trials, n_missing, counts in audits:
+        flagged = ', '.join(f"{phase} {count}" for phase, count in counts.items())
+        print(f"{hdf5_path}: {n_trials} trials, {n_missing} missing; outside tolerance: {flagged}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+from operator import attrgetter
+
+import numpy as np
+from psychopy.iohub.constants import EventConstants
+
+# Batched access to the eye samples of any iohub eye tracker (EyeLink,
+# GazePoint, Tobii or the mouse simulator) while the experiment runs. New
+# sample events are fetched from the tracker and converted to NumPy columns in
+# one step, so online analyses get the same columns as gaze_data.read_samples
+# (time, gaze_x, gaze_y, pupil, status) whatever tracker the lab uses. The
+# samples are also kept in a growing buffer, unless only each new batch is
+# needed (keep=False).
+#
+# Monocular trackers report the tracked eye; for binocular samples the gaze
+# and pupil are the mean of the valid eyes. A status of 0 means a usable
+# sample, as in the .hdf5 datastore.
+
+# Fields of each sample event type, in the order they are read
+MONOCULAR_FIELDS = ('time', 'gaze_x', 'gaze_y', 'pupil_measure1', 'status')
+BINOCULAR_FIELDS = ('time', 'left_gaze_x', 'left_gaze_y', 'left_pupil_measure1',
+                    'right_gaze_x', 'right_gaze_y', 'right_pupil_measure1', 'status')
+
+# iohub binocular status: 2 = right eye invalid, 20 = left eye invalid, 22 = both
+RIGHT_INVALID = (2, 22)
+LEFT_INVALID = (20, 22)
+
+SAMPLE_DTYPE = np.dtype([('time', 'f8'), ('gaze_x', 'f8'), ('gaze_y', 'f8'),
+                         ('pupil', 'f8'), ('status', 'u1')])
+
+
+def _monocular(rows):
+    columns = np.array(rows, dtype='f8').reshape(-1, len(MONOCULAR_FIELDS))
+    samples = np.zeros(len(columns), dtype=SAMPLE_DTYPE)
+    for name, column in zip(SAMPLE_DTYPE.names, columns.T):
+        samples[name] = column
+    return samples
+
+
+def _binocular(rows):
+    columns = np.array(rows, dtype='f8').reshape(-1, len(BINOCULAR_FIELDS))
+    time, lx, ly, lp, rx, ry, rp, status = columns.T
+    left = ~np.isin(status, LEFT_INVALID) & np.isfinite(lx) & np.isfinite(ly)
+    right = ~np.isin(status, RIGHT_INVALID) & np.isfinite(rx) & np.isfinite(ry)
+    n_eyes = left.astype('f8') + right
+    samples = np.zeros(len(columns), dtype=SAMPLE_DTYPE)
+    samples['time'] = time
+    with np.errstate(invalid='ignore', divide='ignore'):
+        samples['gaze_x'] = (np.where(left, lx, 0.0) + np.where(right, rx, 0.0)) / n_eyes
+        samples['gaze_y'] = (np.where(left, ly, 0.0) + np.where(right, ry, 0.0)) / n_eyes
+        samples['pupil'] = (np.where(left, lp, 0.0) + np.where(right, rp, 0.0)) / n_eyes
+    samples['status'] = np.where(n_eyes > 0, 0, np.maximum(status, 2))
+    return samples
+
+
+# Sample event types with the getter and converter of their fields. GazePoint
+# samples have the binocular fields (plus extra ones not read here).
+SAMPLE_EVENTS = [(EventConstants.MONOCULAR_EYE_SAMPLE, attrgetter(*MONOCULAR_FIELDS), _monocular),
+                 (EventConstants.BINOCULAR_EYE_SAMPLE, attrgetter(*BINOCULAR_FIELDS), _binocular)]
+if hasattr(EventConstants, 'GAZEPOINT_SAMPLE'):
+    SAMPLE_EVENTS.append((EventConstants.GAZEPOINT_SAMPLE, attrgetter(*BINOCULAR_FIELDS), _binocular))
+
+
+class TrackerSamples:
+    def __init__(self, tracker, capacity=8192, keep=True):
+        self.tracker = tracker
+        # Whether the samples are kept in the buffer for read_samples_since
+        self.keep = keep
+        self._buffer = np.zeros(capacity if keep else 0, dtype=SAMPLE_DTYPE)
+        self._size = 0
+
+    # Sample events received since the last call (SAMPLE_DTYPE array sorted
+    # by time), also added to the buffer if the samples are kept
+    def read_new(self):
+        batches = []
+        for event_type, fields, convert in SAMPLE_EVENTS:
+            events = self.tracker.getEvents(event_type=event_type)
+            if events:
+                batches.append(convert(list(map(fields, events))))
+        if not batches:
+            return np.zeros(0, dtype=SAMPLE_DTYPE)
+        new = np.concatenate(batches)
+        if len(batches) > 1:
+            new = new[np.argsort(new['time'], kind='stable')]
+        if self.keep:
+            end = self._size + len(new)
+            if end > len(self._buffer):
+                grown = np.zeros(max(end, 2 * len(self._buffer)), dtype=SAMPLE_DTYPE)
+                grown[:self._size] = self._buffer[:self._size]
+                self._buffer = grown
+            self._buffer[self._size:end] = new
+            self._size = end
+        return new
+
+    # Move the sample events received since the last call into the buffer
+    def poll(self):
+        return len(self.read_new())
+
+    # Kept samples with a time (iohub clock, sec) after `t` as a dict of arrays
+    def read_samples_since(self, t):
+        self.poll()
+        buffered = self._buffer[:self._size]
+        first = np.searchsorted(buffered['time'], t, side='right')
+        return {name: buffered[name][first:].copy() for name in SAMPLE_DTYPE.names}
+
+    def clear(self):
+        self._size = 0
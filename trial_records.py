@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# One record per trial for the trial loops. The design columns the loops read
+# and the audio paths are resolved once when the list is loaded, and the
+# loops write the timing, response and data quality of each trial as plain
+# attribute assignments. The DataFrame of the results is only built when the
+# session is saved.
+
+# Design columns read by the trial loops (None if a list does not have one)
+DESIGN_FIELDS = ('Section', 'ID', 'Prime', 'Target', 'Question', 'Dur', 'CorrectA')
+
+# Other names of design columns in some of the lists
+DESIGN_ALIASES = {'CorrrectA': 'CorrectA'}
+
+# Result columns, in the order they are saved. Columns no trial has a value
+# for are not saved.
+RESULT_FIELDS = ('Trial', 'Samples', 'TrackLoss', 'PrecisionRMS', 'FixationOffset',
+                 'Response', 'QuestionOnset', 'ResponseTime', 'RT',
+                 'DwellQuestion', 'DwellTrue', 'DwellFalse')
+
+
+class TrialRecord:
+    __slots__ = ('index', 'prime_path', 'target_path') + DESIGN_FIELDS + RESULT_FIELDS
+
+    def __init__(self, index, design, prime_folder, target_folder):
+        self.index = index
+        for field, value in zip(DESIGN_FIELDS, design):
+            setattr(self, field, value)
+        for field in RESULT_FIELDS:
+            setattr(self, field, None)
+        self.prime_path = os.path.join(prime_folder, self.Prime)
+        self.target_path = os.path.join(target_folder, self.Target)
+
+    # Set result columns from a dict, e.g. TrialQuality.as_dict()
+    def update(self, values):
+        for field, value in values.items():
+            setattr(self, field, value)
+
+
+# The records of a trial list (a DataFrame with a default index, in the order
+# the trials are run), iterated in order
+class TrialStore:
+    def __init__(self, frame, prime_folder, target_folder):
+        self.frame = frame
+        named = frame.rename(columns=DESIGN_ALIASES)
+        columns = [named[field] if field in named else [None] * len(frame)
+                   for field in DESIGN_FIELDS]
+        self.records = [TrialRecord(index, design, prime_folder, target_folder)
+                        for index, design in enumerate(zip(*columns))]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, index):
+        return self.records[index]
+
+    # The trial list with the result columns, NaN where a trial has no value
+    def to_frame(self):
+        frame = self.frame.copy()
+        for field in RESULT_FIELDS:
+            values = [getattr(record, field) for record in self.records]
+            if any(value is not None for value in values):
+                frame[field] = pd.Series([np.nan if value is None else value for value in values],
+                                         index=frame.index)
+        return frame